@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""Benchmark the poller and the Domoticz plugin against simulated sensors."""
+
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+import fakeDomoticz
+from parrot_flower.parrot_flower_fake_backend import SimulatedBackend
+from parrot_flower.parrot_flower_poller import ParrotFlowerPoller
+
+
+def _percentile(values, percent):
+    """Return a percentile of a list of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _summary(values):
+    """Return the usual statistics of a list of durations, in milliseconds."""
+    return {
+        'count': len(values),
+        'mean_ms': round(1000 * sum(values) / len(values), 3) if values else 0.0,
+        'p50_ms': round(1000 * _percentile(values, 50), 3),
+        'p95_ms': round(1000 * _percentile(values, 95), 3),
+        'max_ms': round(1000 * max(values), 3) if values else 0.0,
+    }
+
+
+def bench_poller(macs):
+    """Read every sensor once with a ParrotFlowerPoller, one after the other."""
+    durations = []
+    failures = 0
+    start = time.time()
+    for mac in macs:
+        poller = ParrotFlowerPoller(mac, SimulatedBackend)
+        read_start = time.time()
+        try:
+            poller.read_session()
+        except Exception:  # pylint: disable=broad-except
+            failures += 1
+        durations.append(time.time() - read_start)
+    total = time.time() - start
+    return {
+        'sensors': len(macs),
+        'failures': failures,
+        'duration_s': round(total, 3),
+        'throughput_per_s': round(len(macs) / total, 3) if total else 0.0,
+        'session': _summary(durations),
+    }
+
+
+def bench_plugin(macs, adapters, timeout, ble_timeout=10):
+    """Run BasePlugin heartbeats until every sensor was polled once."""
+    import plugin
+
+    # silence the plugin and make every sensor due at once
+    fakeDomoticz.Log = fakeDomoticz.Debug = fakeDomoticz.Error = lambda message: None
+    plugin.POLL_JITTER = 0
+    # the 255 units limit of Domoticz does not apply to the fake devices
+    plugin.MAX_SENSORS = len(macs)
+
+    home = tempfile.mkdtemp()
+    fakeDomoticz.Devices.clear()
+    plugin.Devices = fakeDomoticz.Devices
+    plugin.Parameters = {
+        "Mode1": "manual", "Mode2": ",".join(macs), "Mode3": "gatttool", "Mode4": "30",
+        "Mode5": ",".join(adapters), "Mode6": "ble_timeout={}".format(ble_timeout), "HomeFolder": home,
+    }
+    plugin.loadBackend = lambda name: SimulatedBackend
+    instance = plugin.BasePlugin()
+    try:
+        instance.onStart()
+
+        heartbeats = []
+        failures = 0
+        start = time.time()
+        done = set()
+        while len(done) < len(macs) and time.time() - start < timeout:
+            beat_start = time.time()
+            instance.onHeartbeat()
+            heartbeats.append(time.time() - beat_start)
+            for mac in macs:
+                if mac not in done and instance.scheduler.failures(mac):
+                    failures += 1
+                    done.add(mac)
+                elif mac not in done and plugin.Devices[instance.sensorUnit(mac)].Updates:
+                    done.add(mac)
+            time.sleep(0.01)
+        total = time.time() - start
+    finally:
+        instance.onStop()
+        shutil.rmtree(home, ignore_errors=True)
+    return {
+        'sensors': len(macs),
+        'adapters': len(adapters),
+        'polled': len(done),
+        'failures': failures,
+        'fleet_poll_s': round(total, 3),
+        'throughput_per_s': round(len(done) / total, 3) if total else 0.0,
+        'heartbeat': _summary(heartbeats),
+    }
+
+
+def main():
+    """Main function.
+
+    Mostly parsing the command line arguments.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sensors', type=int, default=200, help='number of simulated sensors')
+    parser.add_argument('--adapters', default='hci0', help='comma separated adapters used by the plugin')
+    parser.add_argument('--connect-latency', type=float, default=0.05, help='seconds')
+    parser.add_argument('--read-latency', type=float, default=0.005, help='seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='probability of a failed connect or read')
+    parser.add_argument('--hang-probability', type=float, default=0.0, help='probability of a hung connection')
+    parser.add_argument('--hang-time', type=float, default=60.0, help='seconds')
+    parser.add_argument('--ble-timeout', type=int, default=10, help='seconds before a hung connection is cancelled')
+    parser.add_argument('--timeout', type=float, default=600.0, help='maximum duration of the plugin benchmark')
+    parser.add_argument('--skip-poller', action='store_true', help='only benchmark the plugin')
+    parser.add_argument('--skip-plugin', action='store_true', help='only benchmark the poller')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    SimulatedBackend.configure(connect_latency=args.connect_latency, read_latency=args.read_latency,
+                               failure_rate=args.failure_rate, hang_probability=args.hang_probability,
+                               hang_time=args.hang_time)
+    macs = SimulatedBackend.populate(args.sensors)
+
+    results = {}
+    if not args.skip_poller:
+        results['poller'] = bench_poller(macs)
+    if not args.skip_plugin:
+        results['plugin'] = bench_plugin(macs, [adapter.strip() for adapter in args.adapters.split(',')],
+                                         args.timeout, args.ble_timeout)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        for name, result in sorted(results.items()):
+            print('{}:'.format(name))
+            for key, value in sorted(result.items()):
+                print('  {}: {}'.format(key, value))
+
+
+if __name__ == '__main__':
+    main()
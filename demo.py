@@ -2,47 +2,238 @@
 """Demo file showing how to use the parrot_flower library."""
 
 import argparse
+import json
 import re
+import socket
 import logging
+import os
 import sys
+import time
 
 from btlewrap import available_backends, BluepyBackend, GatttoolBackend, PygattBackend
 
-from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, \
-    P_CONDUCTIVITY, P_MOISTURE, P_LIGHT, P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, P_BATTERY
+from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, LIVE_MEASUREMENTS
+from parrot_flower.parrot_flower_worker import PollerPool
+from parrot_flower.parrot_flower_metrics import METRICS
+from parrot_flower.parrot_flower_history import ParrotFlowerHistory, HistoryCursors
+from parrot_flower.parrot_flower_timeseries import TimeSeriesStore
+from parrot_flower.parrot_flower_shared_cache import SharedCache
+from parrot_flower.parrot_flower_cluster import Collector, DEFAULT_PORT
+from parrot_flower.parrot_flower_fake_backend import SimulatedBackend
 from parrot_flower import parrot_flower_scanner
 
 
-def valid_parrot_flower_mac(mac, pat=re.compile(r"A0:14:3D:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}")):
+_MAC = re.compile(r"A0:14:3D:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}")
+
+
+def valid_parrot_flower_mac(mac, pat=_MAC):
     """Check for valid mac adresses."""
     if not pat.match(mac.upper()):
         raise argparse.ArgumentTypeError('The MAC address "{}" seems to be in the wrong format'.format(mac))
     return mac
 
 
+def valid_mac_source(source):
+    """Check that a source of macs is a mac address, an existing file or - for stdin."""
+    if source != '-' and not _MAC.match(source.upper()) and not os.path.isfile(source):
+        raise argparse.ArgumentTypeError('"{}" is neither a MAC address nor an existing file'.format(source))
+    return source
+
+
 def poll(args):
     """Poll data from the sensor."""
     backend = _get_backend(args)
-    poller = ParrotFlowerPoller(args.mac, backend)
+    shared_cache = SharedCache(args.shared_cache) if args.shared_cache else None
+    poller = ParrotFlowerPoller(args.mac, backend, shared_cache=shared_cache)
     print("Getting data from Parrot Flower Power & Pot")
-    print("FW: {}".format(poller.firmware_version()))
-    print("Name: {}".format(poller.name()))
-    print("Batterie: {}".format(poller.parameter_value(P_BATTERY)))
-    print("Air Temperature: {}".format(poller.parameter_value(P_AIR_TEMPERATURE)))
-    print("Sol Temperature: {}".format(poller.parameter_value(P_SOIL_TEMPERATURE)))
-    print("Moisture: {}".format(poller.parameter_value(P_MOISTURE)))
-    print("Light: {}".format(poller.parameter_value(P_LIGHT)))
-    print("Conductivity: {}".format(poller.parameter_value(P_CONDUCTIVITY)))
+    # a single connection for the metadata and all the measurements
+    snapshot = poller.read_session(metadata=True)
+    print("FW: {}".format(snapshot.firmware))
+    print("Name: {}".format(snapshot.name))
+    print("Batterie: {}".format(snapshot.battery))
+    print("Air Temperature: {}".format(snapshot.air_temperature))
+    print("Sol Temperature: {}".format(snapshot.soil_temperature))
+    print("Moisture: {}".format(snapshot.moisture))
+    print("Light: {}".format(snapshot.light))
+    print("Conductivity: {}".format(snapshot.conductivity))
+    if args.store:
+        store = TimeSeriesStore(args.store)
+        store.append(args.mac, time.time(), snapshot.measurements())
+        store.close()
+
+
+def series(args):
+    """Print the readings stored locally for the sensor."""
+    store = TimeSeriesStore(args.store)
+    readings = store.query(args.mac, time.time() - args.hours * 3600)
+    store.close()
+    print('{} readings in the last {} hours:'.format(len(readings), args.hours))
+    for reading in readings:
+        print('  {} {}'.format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(reading.timestamp)),
+                               reading._replace(timestamp=None)))
+
+
+def history(args):
+    """Download the history of the sensor."""
+    backend = _get_backend(args)
+    poller = ParrotFlowerPoller(args.mac, backend)
+    cursors = HistoryCursors(args.cursors) if args.cursors else None
+    block = ParrotFlowerHistory(poller, cursors).sync()
+    print('Downloaded {} entries'.format(block.nb_entries()))
+    for entry in block.entries():
+        print('  {}'.format(entry))
+
+
+def stream(args):
+    """Print the live measurements of a sensor."""
+    backend = _get_backend(args)
+    poller = ParrotFlowerPoller(args.mac, backend)
+    try:
+        live = poller.stream(args.parameters, args.period)
+    except ValueError as error:
+        print(error)
+        return
+    print('Streaming every {} seconds, Ctrl-C to stop...'.format(args.period))
+    try:
+        for reading in live.readings(timeout=args.duration):
+            print('{} {}: {}'.format(reading.timestamp.strftime('%H:%M:%S'), reading.parameter, reading.value))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        live.stop()
+    if live.error is not None:
+        print('Streaming stopped: {}'.format(live.error))
+
+
+def _read_sensor(poller):
+    """Read all the measurements of a sensor, return the JSON record of the result."""
+    start = time.time()
+    record = {'mac': poller.mac(), 'adapter': poller.adapter()}
+    try:
+        snapshot = poller.read_session()
+    except Exception as error:  # pylint: disable=broad-except
+        record.update(ok=False, error='{}: {}'.format(type(error).__name__, error))
+    else:
+        record.update(ok=True, timestamp=snapshot.timestamp.isoformat(), name=snapshot.name,
+                      firmware=snapshot.firmware, **snapshot.measurements())
+    record['duration_s'] = round(time.time() - start, 3)
+    return record
+
+
+def _sensor_macs(args, backend):
+    """Return the macs given on the command line, in the files given, or found by a scan."""
+    macs = []
+    for source in args.macs:
+        if _MAC.match(source.upper()):
+            macs.append(source.upper())
+            continue
+        # a file, or - for stdin, holding macs, the output of the scan command for example
+        if source == '-':
+            for line in sys.stdin:
+                macs.extend(_MAC.findall(line.upper()))
+            continue
+        with open(source) as lines:
+            for line in lines:
+                macs.extend(_MAC.findall(line.upper()))
+    if args.scan:
+        macs.extend(mac for mac, _, _ in parrot_flower_scanner.scan_iter(backend, args.scan, adapter=args.adapters[0]))
+    # without duplicates, in order
+    return list(dict((mac, None) for mac in macs))
+
+
+def _poll_rounds(args, backend, macs, rounds=1):
+    """Poll the sensors concurrently, yield the record of each sensor as soon as it is read."""
+    shared_cache = SharedCache(args.shared_cache) if getattr(args, 'shared_cache', None) else None
+    pollers = [ParrotFlowerPoller(mac, backend, adapter=args.adapters[num % len(args.adapters)],
+                                  ble_timeout=args.ble_timeout, session_timeout=args.session_timeout,
+                                  shared_cache=shared_cache)
+               for num, mac in enumerate(macs)]
+    pool = PollerPool(args.adapters, args.workers, max(len(macs), 1))
+    try:
+        for _ in range(rounds):
+            for poller in pollers:
+                pool.submit(poller.adapter(), poller.mac(), _read_sensor, poller)
+            remaining = len(pollers)
+            while remaining:
+                for _, record, _ in pool.results(timeout=None):
+                    remaining -= 1
+                    yield record
+    finally:
+        pool.stop()
+
+
+def poll_many(args):
+    """Poll several sensors concurrently, print one JSON record per sensor as each one is read."""
+    backend = _get_backend(args)
+    failures = 0
+    for record in _poll_rounds(args, backend, _sensor_macs(args, backend)):
+        failures += not record['ok']
+        print(json.dumps(record, sort_keys=True))
+        sys.stdout.flush()
+    sys.exit(1 if failures else 0)
+
+
+def _stats(durations):
+    """Return the usual statistics of a list of durations, in seconds."""
+    if not durations:
+        return {'count': 0}
+    durations = sorted(durations)
+    return {
+        'count': len(durations),
+        'mean_s': round(sum(durations) / len(durations), 3),
+        'p50_s': round(durations[len(durations) // 2], 3),
+        'p95_s': round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 3),
+        'max_s': round(durations[-1], 3),
+    }
+
+
+def bench(args):
+    """Poll the sensors several times, report the timings of each sensor and of the whole fleet."""
+    backend = _get_backend(args)
+    macs = _sensor_macs(args, backend)
+    durations = dict((mac, []) for mac in macs)
+    failures = dict((mac, 0) for mac in macs)
+    start = time.time()
+    for record in _poll_rounds(args, backend, macs, args.rounds):
+        if record['ok']:
+            durations[record['mac']].append(record['duration_s'])
+        else:
+            failures[record['mac']] += 1
+    total = time.time() - start
+
+    sensors = {}
+    for mac in macs:
+        sensors[mac] = dict(_stats(durations[mac]), failures=failures[mac],
+                            connect_mean_s=round(METRICS.histogram('parrot_flower_connect_seconds', mac=mac).mean(), 3),
+                            read_mean_s=round(METRICS.histogram('parrot_flower_read_seconds', mac=mac).mean(), 3))
+    polls = len(macs) * args.rounds
+    fleet = dict(_stats([duration for mac in macs for duration in durations[mac]]),
+                 sensors=len(macs), rounds=args.rounds, failures=sum(failures.values()),
+                 duration_s=round(total, 3), throughput_per_s=round(polls / total, 3) if total else 0.0)
+    if args.json:
+        print(json.dumps({'sensors': sensors, 'fleet': fleet}, indent=2, sort_keys=True))
+        return
+    print('{:<18} {:>6} {:>8} {:>8} {:>8} {:>10} {:>8}'.format('sensor', 'polls', 'mean', 'p95', 'max', 'connect', 'failed'))
+    for mac in macs:
+        result = sensors[mac]
+        print('{:<18} {:>6} {:>8} {:>8} {:>8} {:>10} {:>8}'.format(
+            mac, result['count'], result.get('mean_s', '-'), result.get('p95_s', '-'), result.get('max_s', '-'),
+            result['connect_mean_s'], result['failures']))
+    print('fleet: {} sensors x {} rounds in {} s, {} polls/s, {} failed, session mean {} s, p95 {} s'.format(
+        fleet['sensors'], fleet['rounds'], fleet['duration_s'], fleet['throughput_per_s'], fleet['failures'],
+        fleet.get('mean_s', '-'), fleet.get('p95_s', '-')))
 
 
 def scan(args):
     """Scan for sensors."""
     backend = _get_backend(args)
-    print('Scanning for 10 seconds...')
-    devices = parrot_flower_scanner.scan(backend, 10)
-    print('Found {} devices:'.format(len(devices)))
-    for device in devices:
-        print('  {}'.format(device))
+    print('Scanning for {} seconds...'.format(args.timeout))
+    found = 0
+    for mac, name, rssi in parrot_flower_scanner.scan_iter(backend, args.timeout, expected=args.expected,
+                                                           count=args.count, adapter=args.adapter):
+        found += 1
+        print('  {} {} {}'.format(mac, name or '', '' if rssi is None else '{} dBm'.format(rssi)))
+    print('Found {} devices'.format(found))
 
 
 def _get_backend(args):
@@ -53,11 +244,29 @@ def _get_backend(args):
         backend = BluepyBackend
     elif args.backend == 'pygatt':
         backend = PygattBackend
+    elif args.backend == 'simulated':
+        # the same sensors in every process, each adapter name receives them with its own signal
+        SimulatedBackend.configure(connect_latency=0.2, read_latency=0.02, advertising_interval=0.5)
+        SimulatedBackend.populate(args.simulated_sensors)
+        backend = SimulatedBackend
     else:
         raise Exception('unknown backend: {}'.format(args.backend))
     return backend
 
 
+def collect(args):
+    """Poll the sensors leased by a coordinator, until interrupted."""
+    backend = _get_backend(args)
+    host, _, port = args.coordinator.partition(':')
+    collector = Collector(args.node, (host, int(port or DEFAULT_PORT)), backend, args.adapter, args.key,
+                          args.scan_timeout)
+    print('Collecting for {} as node {}, Ctrl-C to stop...'.format(args.coordinator, args.node))
+    try:
+        collector.run()
+    except KeyboardInterrupt:
+        pass
+
+
 def list_backends(_):
     """List all available backends."""
     backends = [b.__name__ for b in available_backends()]
@@ -70,17 +279,70 @@ def main():
     Mostly parsing the command line arguments.
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument('--backend', choices=['gatttool', 'bluepy', 'pygatt'], default='gatttool')
+    parser.add_argument('--backend', choices=['gatttool', 'bluepy', 'pygatt', 'simulated'], default='gatttool')
+    parser.add_argument('--simulated-sensors', type=int, default=10, help='number of sensors of the simulated backend')
     parser.add_argument('-v', '--verbose', action='store_const', const=True)
     subparsers = parser.add_subparsers(help='sub-command help', )
 
     parser_poll = subparsers.add_parser('poll', help='poll data from a sensor')
     parser_poll.add_argument('mac', type=valid_parrot_flower_mac)
+    parser_poll.add_argument('--store', help='directory of the time series to append the reading to')
+    parser_poll.add_argument('--shared-cache', help='directory of the readings shared with the plugin and other scripts')
     parser_poll.set_defaults(func=poll)
 
+    parser_series = subparsers.add_parser('series', help='print the readings stored locally')
+    parser_series.add_argument('mac', type=valid_parrot_flower_mac)
+    parser_series.add_argument('--store', required=True, help='directory of the time series')
+    parser_series.add_argument('--hours', type=float, default=24, help='number of hours to print')
+    parser_series.set_defaults(func=series)
+
+    parser_stream = subparsers.add_parser('stream', help='print the live measurements of a sensor (not with gatttool)')
+    parser_stream.add_argument('mac', type=valid_parrot_flower_mac)
+    parser_stream.add_argument('--period', type=int, default=5, help='seconds between two measurements')
+    parser_stream.add_argument('--parameters', nargs='+', choices=LIVE_MEASUREMENTS, default=LIVE_MEASUREMENTS)
+    parser_stream.add_argument('--duration', type=float, help='stop when no measurement arrived for that many seconds')
+    parser_stream.set_defaults(func=stream)
+
+    parser_history = subparsers.add_parser('history', help='download the history of a sensor')
+    parser_history.add_argument('mac', type=valid_parrot_flower_mac)
+    parser_history.add_argument('--cursors', help='file remembering the downloaded entries, for incremental downloads')
+    parser_history.set_defaults(func=history)
+
+    parser_poll_many = subparsers.add_parser('poll-many', help='poll several sensors concurrently, print JSON lines')
+    parser_bench = subparsers.add_parser('bench', help='time the polls of several sensors')
+    for sub_parser in (parser_poll_many, parser_bench):
+        sub_parser.add_argument('macs', nargs='*', type=valid_mac_source,
+                                help='macs, or files holding macs (- for stdin), the output of scan for example')
+        sub_parser.add_argument('--scan', type=float, help='also poll the sensors found by a scan of that many seconds')
+        sub_parser.add_argument('--adapters', type=lambda value: [adapter.strip() for adapter in value.split(',')],
+                                default=['hci0'], help='comma separated bluetooth adapters, used in parallel')
+        sub_parser.add_argument('--workers', type=int, default=1,
+                                help='worker threads per adapter. The polls of an adapter are serialized, extra '
+                                     'workers wait for it and do not poll faster, use more adapters for that')
+        sub_parser.add_argument('--ble-timeout', type=float, default=10, help='seconds to connect to a sensor')
+        sub_parser.add_argument('--session-timeout', type=float, default=30, help='seconds to read a sensor')
+    parser_poll_many.add_argument('--shared-cache', help='directory of the readings shared with the plugin and other scripts')
+    parser_poll_many.set_defaults(func=poll_many)
+    parser_bench.add_argument('--rounds', type=int, default=3, help='number of polls of each sensor')
+    parser_bench.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser_bench.set_defaults(func=bench)
+
     parser_scan = subparsers.add_parser('scan', help='scan for devices')
+    parser_scan.add_argument('--timeout', type=float, default=10, help='maximum duration of the scan, in seconds')
+    parser_scan.add_argument('--expected', nargs='*', type=valid_parrot_flower_mac,
+                             help='stop once these sensors were found')
+    parser_scan.add_argument('--count', type=int, help='stop once this number of sensors were found')
+    parser_scan.add_argument('--adapter', default='hci0', help='bluetooth adapter used for the scan')
     parser_scan.set_defaults(func=scan)
 
+    parser_collect = subparsers.add_parser('collect', help='poll the sensors leased by the coordinator of the plugin')
+    parser_collect.add_argument('coordinator', help='host:port of the coordinator')
+    parser_collect.add_argument('--node', default=socket.gethostname(), help='unique name of this collector')
+    parser_collect.add_argument('--adapter', default='hci0', help='bluetooth adapter used by this collector')
+    parser_collect.add_argument('--key', help='secret shared with the coordinator')
+    parser_collect.add_argument('--scan-timeout', type=float, default=10, help='seconds')
+    parser_collect.set_defaults(func=collect)
+
     parser_scan = subparsers.add_parser('backends', help='list the available backends')
     parser_scan.set_defaults(func=list_backends)
 
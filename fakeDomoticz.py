@@ -19,3 +19,29 @@ def Debug(s):
 
 def Error(s):
     print(s)
+
+def Debugging(level):
+    pass
+
+# devices created by the plugin, the plugin module must use it as its Devices
+Devices = {}
+
+class Device:
+    def __init__(self, Name="", Unit=0, TypeName="", Used=0, **kwargs):
+        self.Name = Name
+        self.Unit = Unit
+        self.TypeName = TypeName
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.BatteryLevel = 255
+        self.Updates = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=0, sValue="", BatteryLevel=255, **kwargs):
+        self.nValue = nValue
+        self.sValue = sValue
+        self.BatteryLevel = BatteryLevel
+        self.Updates += 1
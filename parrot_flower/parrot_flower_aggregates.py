@@ -0,0 +1,296 @@
+"""
+Rolling statistics of the readings of Parrot Flower Power & Pot sensors.
+
+Each reading updates the statistics of its sensor in constant amortized
+time: the minimum, maximum and mean of the moisture and temperatures over
+a sliding window, and the daily light integral (the light received over
+the last 24 hours). The statistics are saved in a JSON file, replaced
+atomically, so that they survive restarts.
+"""
+
+from collections import deque
+import json
+import logging
+import os
+from threading import Lock
+
+from parrot_flower.parrot_flower_poller import P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, P_MOISTURE, P_LIGHT
+
+_LOGGER = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+# measurements with min/max/mean statistics
+WINDOW_MEASUREMENTS = (P_MOISTURE, P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE)
+# default longest gap between two readings over which the light is integrated,
+# a longer gap means the sensor could not be polled
+MAX_LIGHT_GAP = 3 * 3600
+
+
+class SlidingWindow(object):
+    """
+    Minimum, maximum and mean of the values of the last window seconds.
+
+    The values are kept in time order with their running sum, and in two
+    monotonic queues whose heads are the minimum and the maximum, so adding
+    a value costs O(1) amortized whatever the size of the window.
+    """
+
+    def __init__(self, window):
+        self._window = window
+        self._values = deque()  # (time, value), oldest first
+        self._sum = 0.0
+        self._min = deque()  # increasing values, the head is the minimum
+        self._max = deque()  # decreasing values, the head is the maximum
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def add(self, timestamp, value):
+        """Add a value, timestamp must not be older than the last value."""
+        self._values.append((timestamp, value))
+        self._sum += value
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((timestamp, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((timestamp, value))
+        self.expire(timestamp)
+
+
+    def expire(self, now):
+        """Drop the values older than the window."""
+        oldest = now - self._window
+        while self._values and self._values[0][0] <= oldest:
+            self._sum -= self._values.popleft()[1]
+        while self._min and self._min[0][0] <= oldest:
+            self._min.popleft()
+        while self._max and self._max[0][0] <= oldest:
+            self._max.popleft()
+        if not self._values:
+            self._sum = 0.0  # do not keep the rounding errors of the running sum
+
+
+    def min(self):
+        """Return the minimum of the values, or None."""
+        return self._min[0][1] if self._min else None
+
+
+    def max(self):
+        """Return the maximum of the values, or None."""
+        return self._max[0][1] if self._max else None
+
+
+    def mean(self):
+        """Return the mean of the values, or None."""
+        return self._sum / len(self._values) if self._values else None
+
+
+    def state(self):
+        """Return the values, to be saved."""
+        return list(self._values)
+
+
+    def restore(self, values):
+        """Add saved values."""
+        for timestamp, value in values:
+            self.add(timestamp, value)
+
+
+class LightIntegral(object):
+    """
+    Light received over the last 24 hours, in mol/m2.
+
+    The light of the sensor is a photosynthetic photon flux density, in
+    umol/m2/s (lux / 54). The flux between two readings is taken as their
+    average, the increments of the last 24 hours are kept with their sum.
+    """
+
+    def __init__(self, max_gap=MAX_LIGHT_GAP):
+        self._max_gap = max_gap
+        self._last = None  # (time, value) of the last reading
+        self._increments = deque()  # (time, mol/m2 since the previous reading), oldest first
+        self._sum = 0.0
+
+
+    def add(self, timestamp, value):
+        """Add a reading, timestamp must not be older than the last reading."""
+        if self._last is not None:
+            elapsed = timestamp - self._last[0]
+            if 0 < elapsed <= self._max_gap:
+                increment = (self._last[1] + value) / 2.0 * elapsed / 1e6
+                self._increments.append((timestamp, increment))
+                self._sum += increment
+        self._last = (timestamp, value)
+        self.expire(timestamp)
+
+
+    def expire(self, now):
+        """Drop the increments older than a day."""
+        while self._increments and self._increments[0][0] <= now - DAY:
+            self._sum -= self._increments.popleft()[1]
+        if not self._increments:
+            self._sum = 0.0
+
+
+    def value(self):
+        """Return the daily light integral in mol/m2, or None when no light was integrated over the last day."""
+        if not self._increments:
+            return None
+        return max(self._sum, 0.0)
+
+
+    def state(self):
+        """Return the last reading and the increments, to be saved."""
+        return {'last': self._last, 'increments': list(self._increments)}
+
+
+    def restore(self, state):
+        """Restore a saved state."""
+        for timestamp, increment in state['increments']:
+            self._increments.append((timestamp, increment))
+            self._sum += increment
+        self._last = tuple(state['last']) if state['last'] is not None else None
+
+
+class SensorAggregates(object):
+    """
+    The rolling statistics of one sensor.
+    """
+
+    def __init__(self, window=DAY, max_light_gap=MAX_LIGHT_GAP):
+        self.windows = dict((parameter, SlidingWindow(window)) for parameter in WINDOW_MEASUREMENTS)
+        self.light = LightIntegral(max_light_gap)
+        self.last = None  # time of the last reading
+
+
+    def add(self, timestamp, values):
+        """Add a reading, values maps the P_* parameters to their value (None when missing).
+
+        A reading older than the last one (pushed late by a collector node) is ignored.
+        """
+        if self.last is not None and timestamp < self.last:
+            return
+        self.last = timestamp
+        for parameter, window in self.windows.items():
+            if values.get(parameter) is not None:
+                window.add(timestamp, values[parameter])
+        if values.get(P_LIGHT) is not None:
+            self.light.add(timestamp, values[P_LIGHT])
+
+
+    def expire(self, now):
+        """Drop the readings which left the windows."""
+        for window in self.windows.values():
+            window.expire(now)
+        self.light.expire(now)
+
+
+    def stats(self):
+        """Return the statistics as a dict: dli and <parameter>_min, _max and _mean, None when unknown."""
+        stats = {'dli': self.light.value()}
+        for parameter, window in self.windows.items():
+            stats[parameter + '_min'] = window.min()
+            stats[parameter + '_max'] = window.max()
+            stats[parameter + '_mean'] = window.mean()
+        return stats
+
+
+    def state(self):
+        return {'last': self.last,
+                'windows': dict((parameter, window.state()) for parameter, window in self.windows.items()),
+                'light': self.light.state()}
+
+
+    def restore(self, state):
+        for parameter, values in state['windows'].items():
+            if parameter in self.windows:
+                self.windows[parameter].restore(values)
+        self.light.restore(state['light'])
+        self.last = state['last']
+
+
+class AggregateStore(object):
+    """
+    The rolling statistics of several sensors, by MAC address, saved in a file.
+    """
+
+    def __init__(self, filename, window=DAY, max_light_gap=MAX_LIGHT_GAP):
+        """
+        Load the statistics saved in filename, window is the length in seconds of the min/max/mean windows.
+
+        The light is not integrated between two readings more than max_light_gap seconds apart.
+        """
+        self._filename = filename
+        self._window = window
+        self._max_light_gap = max_light_gap
+        self._sensors = {}
+        self._dirty = False
+        self._lock = Lock()
+        self._load()
+
+
+    def _load(self):
+        """Load the saved statistics, a missing or invalid file starts them over."""
+        try:
+            with open(self._filename) as saved:
+                content = json.load(saved)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            _LOGGER.warning('Ignoring the aggregates in %s: %s', self._filename, error)
+            return
+        for mac, state in content.items():
+            aggregates = SensorAggregates(self._window, self._max_light_gap)
+            try:
+                aggregates.restore(state)
+            except (KeyError, TypeError, ValueError):
+                _LOGGER.warning('Ignoring the invalid aggregates of %s', mac)
+                continue
+            self._sensors[mac] = aggregates
+
+
+    def add(self, mac, timestamp, values):
+        """Add a reading of a sensor and return its statistics, see SensorAggregates.stats()."""
+        mac = mac.upper()
+        with self._lock:
+            aggregates = self._sensors.get(mac)
+            if aggregates is None:
+                aggregates = SensorAggregates(self._window, self._max_light_gap)
+                self._sensors[mac] = aggregates
+            aggregates.add(timestamp, values)
+            self._dirty = True
+            return aggregates.stats()
+
+
+    def stats(self, mac, now=None):
+        """Return the statistics of a sensor at now (the last reading if None), or None."""
+        with self._lock:
+            aggregates = self._sensors.get(mac.upper())
+            if aggregates is None:
+                return None
+            if now is not None:
+                aggregates.expire(now)
+            return aggregates.stats()
+
+
+    def forget(self, mac):
+        """Drop the statistics of a sensor."""
+        with self._lock:
+            if self._sensors.pop(mac.upper(), None) is not None:
+                self._dirty = True
+
+
+    def save(self):
+        """Write the statistics if they changed since the last save, atomically."""
+        with self._lock:
+            if not self._dirty:
+                return
+            content = dict((mac, aggregates.state()) for mac, aggregates in self._sensors.items())
+            self._dirty = False
+        temporary = self._filename + '.tmp'
+        with open(temporary, 'w') as saved:
+            json.dump(content, saved)
+        os.replace(temporary, self._filename)
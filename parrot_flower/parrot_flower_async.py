@@ -0,0 +1,101 @@
+"""
+asyncio interface to Parrot Flower Power & Pot sensors.
+
+The Bluetooth backends are blocking, the reads run in an executor so that
+several sensors can be polled concurrently from one event loop.
+"""
+
+import asyncio
+from functools import partial
+import logging
+from btlewrap.base import BluetoothBackendException
+
+from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, MEASUREMENTS
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncParrotFlowerPoller(object):
+    """"
+    A class to read data from Parrot plant sensors from asyncio code.
+    """
+
+    def __init__(self, mac, backend, executor=None, loop=None, **kwargs):
+        """
+        Initialize an asyncio poller for the given MAC address.
+
+        The keyword arguments are passed to ParrotFlowerPoller, the reads run
+        in executor (the loop default executor if None).
+        """
+
+        self._poller = ParrotFlowerPoller(mac, backend, **kwargs)
+        self._executor = executor
+        self._loop = loop
+
+
+    @property
+    def poller(self):
+        """The underlying synchronous poller."""
+        return self._poller
+
+
+    def _run(self, func, *args):
+        """Run func(*args) in the executor."""
+        loop = self._loop or asyncio.get_event_loop()
+        return loop.run_in_executor(self._executor, partial(func, *args))
+
+
+    async def name(self):
+        """Return the name of the sensor."""
+        return await self._run(self._poller.name)
+
+
+    async def firmware_version(self):
+        """Return the firmware version."""
+        return await self._run(self._poller.firmware_version)
+
+
+    async def fill_cache(self, parameters=None):
+        """Fill the cache with new data from the sensor."""
+        return await self._run(self._poller.fill_cache, parameters)
+
+
+    async def read_session(self, parameters=MEASUREMENTS, metadata=None):
+        """Read the given parameters over a single connection, see ParrotFlowerPoller.read_session()."""
+        return await self._run(self._poller.read_session, parameters, metadata)
+
+
+    async def parameter_value(self, parameter, read_cached=True):
+        """Return a value of one of the monitored paramaters."""
+        return await self._run(self._poller.parameter_value, parameter, read_cached)
+
+
+async def poll_many(macs, backend, concurrency=4, deadline=30, parameters=MEASUREMENTS,
+                    executor=None, **kwargs):
+    """Poll several sensors concurrently.
+
+    At most concurrency sensors are read at the same time and each one has
+    deadline seconds to answer. Return a dict mac -> ParrotFlowerSnapshot, or
+    the exception raised when the sensor could not be read.
+
+    Note: a timed out read is abandoned, not interrupted, it still occupies
+    an executor thread until the backend gives up.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def poll_one(mac):
+        """Poll a single sensor."""
+        async with semaphore:
+            poller = AsyncParrotFlowerPoller(mac, backend, executor=executor, **kwargs)
+            try:
+                snapshot = await asyncio.wait_for(poller.read_session(parameters), deadline)
+            except asyncio.TimeoutError:
+                _LOGGER.debug('Timeout reading sensor %s', mac)
+                return mac, BluetoothBackendException("Timeout reading sensor %s" % mac)
+            except BluetoothBackendException as error:
+                _LOGGER.debug('Error reading sensor %s: %s', mac, error)
+                return mac, error
+            return mac, snapshot
+
+    results = await asyncio.gather(*[poll_one(mac) for mac in macs])
+    return dict(results)
@@ -0,0 +1,356 @@
+"""
+Share the polling of the sensors between several hosts.
+
+The Domoticz plugin runs a Coordinator. Collector nodes, each with its own
+bluetooth adapter, scan for the sensors and claim the ones they receive:
+the coordinator leases each sensor to the node receiving it with the best
+signal. The nodes poll their leased sensors and push the snapshots to the
+coordinator.
+
+The protocol is one JSON object per line over TCP, one request and one
+reply per connection:
+
+    {"type": "claim", "node": "shed", "sensors": {"A0:14:3D:00:00:01": -70}}
+    -> {"type": "leases", "leases": {"A0:14:3D:00:00:01": 1700000000.0}, "interval": 3600}
+    {"type": "snapshot", "node": "shed", "mac": "A0:14:3D:00:00:01", "timestamp": 1700000000.0,
+     "name": "Flower power", "firmware": "1.1.0", "values": {"moisture": 25, ...}}
+    -> {"type": "ok"}
+
+Errors are replied as {"type": "error", "error": "..."}.
+"""
+
+import hmac
+import json
+import logging
+import math
+from numbers import Integral, Real
+from queue import Queue, Empty
+import re
+import socket
+import socketserver
+from threading import Lock, Thread
+import time
+
+from btlewrap.base import BluetoothBackendException
+
+from parrot_flower import parrot_flower_scanner
+from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, MEASUREMENTS, P_BATTERY, P_CONDUCTIVITY
+
+_LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PORT = 9853
+# a node must receive a sensor this much better (dB) to take it over from its holder
+HANDOVER_MARGIN = 6
+# signal of the sensors received without RSSI, any measured signal is better
+_NO_RSSI = -1000
+_MAX_MESSAGE = 64 * 1024
+# the MAC addresses of the sensors, the others are refused (they end up in file names)
+_MAC = re.compile(r"A0:14:3D:[0-9A-F]{2}:[0-9A-F]{2}:[0-9A-F]{2}$")
+
+
+class LeaseTable(object):
+    """
+    Which node polls which sensor.
+
+    A sensor is leased to the node receiving it with the best signal, for
+    lease_time seconds. The holder renews its lease with each claim, a node
+    receiving the sensor more than margin dB better than the holder takes
+    the lease over. The lease of a node which stopped claiming expires.
+    """
+
+    def __init__(self, lease_time=3600, margin=HANDOVER_MARGIN, allowed=None, clock=time.time):
+        """
+        allowed, if given, is called with a mac and returns False for the sensors which must not be leased.
+        """
+        self._lease_time = lease_time
+        self._margin = margin
+        self._allowed = allowed
+        self._clock = clock
+        self._leases = {}  # mac -> (node, expiry)
+        self._signals = {}  # mac -> {node: (rssi, time)}
+        self._lock = Lock()
+
+
+    def claim(self, node, sensors):
+        """Record the signal (dBm or None) of the sensors received by a node.
+
+        Return {mac: expiry} for the sensors leased to the node.
+        """
+        now = self._clock()
+        granted = {}
+        with self._lock:
+            for mac, rssi in sensors.items():
+                mac = mac.upper()
+                self._signals.setdefault(mac, {})[node] = (_NO_RSSI if rssi is None else rssi, now)
+            for mac in sensors:
+                mac = mac.upper()
+                if self._allowed is not None and not self._allowed(mac):
+                    continue
+                if self._grant(mac, node, now):
+                    expiry = now + self._lease_time
+                    self._leases[mac] = (node, expiry)
+                    granted[mac] = expiry
+        return granted
+
+
+    def _grant(self, mac, node, now):
+        """Check if a node gets (or keeps) the lease of a sensor."""
+        holder = self._leases.get(mac)
+        if holder is not None and holder[1] <= now:
+            holder = None
+        signals = dict((other, rssi) for other, (rssi, seen) in self._signals[mac].items()
+                       if now - seen < self._lease_time)
+        best = max(signals.values())
+        if holder is None:
+            return signals[node] >= best
+        if holder[0] == node:
+            return True
+        if signals[node] > signals.get(holder[0], _NO_RSSI) + self._margin:
+            _LOGGER.info('Handing sensor %s over from node %s to node %s', mac, holder[0], node)
+            return True
+        return False
+
+
+    def holder(self, mac):
+        """Return the node holding the lease of a sensor, or None."""
+        with self._lock:
+            holder = self._leases.get(mac.upper())
+            if holder is None or holder[1] <= self._clock():
+                return None
+            return holder[0]
+
+
+    def leases(self):
+        """Return {mac: node} for all the live leases."""
+        now = self._clock()
+        with self._lock:
+            return dict((mac, node) for mac, (node, expiry) in self._leases.items() if expiry > now)
+
+
+def _check_key(message, key):
+    """Check the shared secret of a message, if the coordinator has one."""
+    return key is None or hmac.compare_digest(str(message.get('key', '')), key)
+
+
+def _valid_mac(mac):
+    """Check that a MAC address sent by a node is the address of a sensor."""
+    return isinstance(mac, str) and _MAC.match(mac.upper()) is not None
+
+
+# ranges of the measurements which are integers
+_INTEGER_MEASUREMENTS = {P_BATTERY: (0, 100), P_CONDUCTIVITY: (0, 65535)}
+
+
+def _number(value):
+    """Check that a value sent by a node is a finite number (a bool, NaN or infinity is not)."""
+    if isinstance(value, bool) or not isinstance(value, Real):
+        return False
+    try:
+        return math.isfinite(value)
+    except OverflowError:  # an integer too large for a float
+        return False
+
+
+def _valid_value(parameter, value):
+    """Check that a measurement sent by a node is a finite number, an integer in range for the integer ones."""
+    if parameter not in _INTEGER_MEASUREMENTS:
+        return _number(value)
+    low, high = _INTEGER_MEASUREMENTS[parameter]
+    return isinstance(value, Integral) and not isinstance(value, bool) and low <= value <= high
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    Handle one request of a collector node.
+    """
+
+    def handle(self):
+        try:
+            message = json.loads(self.rfile.readline(_MAX_MESSAGE).decode('utf-8'))
+            reply = self.server.coordinator._handle(message)  # pylint: disable=protected-access
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            reply = {'type': 'error', 'error': 'invalid message: %s' % error}
+        self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Coordinator(object):
+    """
+    Lease the sensors to the collector nodes and receive their snapshots.
+
+    The server runs in a background thread. The snapshots are collected
+    with snapshots(), from the thread of the caller.
+    """
+
+    def __init__(self, leases, host='127.0.0.1', port=DEFAULT_PORT, key=None, interval=3600):
+        """
+        Listen on host:port (port 0 picks a free port), '' listens on all the interfaces.
+
+        leases is the LeaseTable of the sensors, key an optional secret the
+        nodes must send with their messages, interval the number of seconds
+        between two polls of a sensor.
+        """
+        self._leases = leases
+        self._key = key
+        self._interval = interval
+        self._snapshots = Queue()
+        self._server = _Server((host, port), _Handler)
+        self._server.coordinator = self
+        self._thread = Thread(target=self._server.serve_forever, name='ParrotFlowerCoordinator')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def address(self):
+        """Return the (host, port) the coordinator listens on."""
+        return self._server.server_address
+
+
+    def snapshots(self):
+        """Return the (node, snapshot) received since the last call, snapshot being the message."""
+        received = []
+        while True:
+            try:
+                received.append(self._snapshots.get_nowait())
+            except Empty:
+                return received
+
+
+    def stop(self):
+        """Stop the server."""
+        self._server.shutdown()
+        self._server.server_close()
+
+
+    def _handle(self, message):
+        """Reply to a message of a node, from a thread of the server."""
+        if not _check_key(message, self._key):
+            return {'type': 'error', 'error': 'invalid key'}
+        node = str(message['node'])
+        if message['type'] == 'claim':
+            sensors = dict(message['sensors'])
+            if not all(_valid_mac(mac) and (rssi is None or _number(rssi)) for mac, rssi in sensors.items()):
+                return {'type': 'error', 'error': 'invalid sensors'}
+            leases = self._leases.claim(node, sensors)
+            return {'type': 'leases', 'leases': leases, 'interval': self._interval}
+        if message['type'] == 'snapshot':
+            if not _valid_mac(message['mac']):
+                return {'type': 'error', 'error': 'invalid mac'}
+            mac = message['mac'].upper()
+            if self._leases.holder(mac) != node:
+                return {'type': 'error', 'error': 'sensor %s is not leased to %s' % (mac, node)}
+            if not _number(message['timestamp']):
+                return {'type': 'error', 'error': 'invalid timestamp'}
+            values = dict(message['values'])
+            if any(parameter not in values for parameter in MEASUREMENTS):
+                return {'type': 'error', 'error': 'incomplete snapshot'}
+            if not all(_valid_value(parameter, values[parameter]) for parameter in MEASUREMENTS):
+                return {'type': 'error', 'error': 'invalid values'}
+            for field in ('name', 'firmware'):
+                if message.get(field) is not None and not isinstance(message[field], str):
+                    return {'type': 'error', 'error': 'invalid %s' % field}
+            message['mac'] = mac
+            message['values'] = dict((parameter, values[parameter]) for parameter in MEASUREMENTS)
+            self._snapshots.put((node, message))
+            return {'type': 'ok'}
+        return {'type': 'error', 'error': 'unknown message type %s' % message['type']}
+
+
+class Collector(object):
+    """
+    A node polling the sensors leased by a coordinator.
+    """
+
+    def __init__(self, node, address, backend, adapter='hci0', key=None, scan_timeout=10,
+                 timeout=10, **poller_options):
+        """
+        Poll for the coordinator listening at address (host, port).
+
+        node is the unique name of the collector, poller_options are passed
+        to the ParrotFlowerPoller of each sensor.
+        """
+        self._node = node
+        self._address = address
+        self._backend = backend
+        self._adapter = adapter
+        self._key = key
+        self._scan_timeout = scan_timeout
+        self._timeout = timeout
+        self._poller_options = poller_options
+        self._pollers = {}
+        self.interval = None
+
+
+    def _request(self, message):
+        """Send a message to the coordinator and return its reply."""
+        message = dict(message, node=self._node)
+        if self._key is not None:
+            message['key'] = self._key
+        with socket.create_connection(self._address, self._timeout) as connection:
+            connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            with connection.makefile('rb') as stream:
+                reply = json.loads(stream.readline(_MAX_MESSAGE).decode('utf-8'))
+        if reply.get('type') == 'error':
+            raise ValueError(reply['error'])
+        return reply
+
+
+    def _poller(self, mac):
+        """Return the poller of a sensor, kept between the cycles."""
+        poller = self._pollers.get(mac)
+        if poller is None:
+            poller = ParrotFlowerPoller(mac, self._backend, adapter=self._adapter, **self._poller_options)
+            self._pollers[mac] = poller
+        return poller
+
+
+    def cycle(self):
+        """Scan, claim the sensors received, poll the leased ones and push their snapshots.
+
+        Return the number of snapshots accepted by the coordinator.
+        """
+        sensors = dict((mac, rssi) for mac, _, rssi in
+                       parrot_flower_scanner.scan_iter(self._backend, self._scan_timeout, adapter=self._adapter))
+        reply = self._request({'type': 'claim', 'sensors': sensors})
+        self.interval = reply['interval']
+        leased = sorted(reply['leases'])
+        _LOGGER.info('Node %s received %d sensors, %d leased', self._node, len(sensors), len(leased))
+        for mac in list(self._pollers):
+            if mac not in leased:
+                del self._pollers[mac]
+
+        pushed = 0
+        for mac in leased:
+            try:
+                snapshot = self._poller(mac).read_session()
+            except BluetoothBackendException as error:
+                _LOGGER.warning('Could not poll %s: %s', mac, error)
+                continue
+            try:
+                self._request({'type': 'snapshot', 'mac': mac, 'timestamp': snapshot.timestamp.timestamp(),
+                               'name': snapshot.name, 'firmware': snapshot.firmware,
+                               'values': snapshot.measurements()})
+                pushed += 1
+            except ValueError as error:
+                _LOGGER.warning('Snapshot of %s refused: %s', mac, error)
+        return pushed
+
+
+    def run(self, stop=None):
+        """Run cycles every interval of the coordinator, until the stop Event is set."""
+        while stop is None or not stop.is_set():
+            start = time.time()
+            try:
+                self.cycle()
+            except (OSError, ValueError) as error:
+                _LOGGER.error('Collector cycle failed: %s', error)
+            delay = (self.interval or 60) - (time.time() - start)
+            if stop is not None:
+                if stop.wait(max(delay, 1)):
+                    break
+            else:
+                time.sleep(max(delay, 1))
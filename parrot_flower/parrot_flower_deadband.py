@@ -0,0 +1,45 @@
+"""
+Skip publishing readings which did not change significantly.
+"""
+
+import time
+
+
+class Deadband(object):
+    """
+    Decide which readings are worth publishing.
+
+    A reading is published when it moved more than the deadband of its
+    metric since the last published one, when the battery level changed,
+    or when the last published one is older than max_age seconds.
+    """
+
+    def __init__(self, deadbands, max_age, clock=time.time):
+        """
+        deadbands maps metric names to the largest change which is not published.
+        """
+        self._deadbands = dict(deadbands)
+        self._max_age = max_age
+        self._clock = clock
+        self._published = {}  # key -> (value, battery, time)
+
+
+    def should_publish(self, key, metric, value, battery=None):
+        """Check if a reading has to be published."""
+        last = self._published.get(key)
+        if last is None:
+            return True
+        last_value, last_battery, last_time = last
+        if battery != last_battery or self._clock() - last_time >= self._max_age:
+            return True
+        return abs(value - last_value) > self._deadbands.get(metric, 0)
+
+
+    def published(self, key, value, battery=None):
+        """Record that a reading was published."""
+        self._published[key] = (value, battery, self._clock())
+
+
+    def forget(self, key):
+        """Forget the last published reading, the next one is always published."""
+        self._published.pop(key, None)
@@ -0,0 +1,125 @@
+"""
+Decode the raw payloads of Parrot Flower Power & Pot sensors.
+
+Single values read from the handles are decoded with the decode_* functions,
+blocks of fixed-width records (the history, replays) are decoded in batches
+into columns. NumPy is used for the batches when it is installed, the array
+module otherwise.
+"""
+
+from array import array
+from struct import unpack
+import sys
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SOIL_TEMPERATURE_MIN = -10.0
+SOIL_TEMPERATURE_MAX = 55.0
+
+_TABLE_LOCK = Lock()
+_TEMPERATURE_TABLE = None
+
+
+def _raw_to_temperature(raw_value):
+    """Convert a raw 16 bits temperature to degrees Celsius."""
+    temperature = 0.00000003044 * pow(raw_value, 3.0) - 0.00008038 * pow(raw_value, 2.0) + raw_value * 0.1149 - 30.49999999999999
+    if temperature < SOIL_TEMPERATURE_MIN:
+        temperature = SOIL_TEMPERATURE_MIN
+    elif temperature > SOIL_TEMPERATURE_MAX:
+        temperature = SOIL_TEMPERATURE_MAX
+    return round(temperature, 1)
+
+
+def temperature_table():
+    """Return the table of the temperatures of all the 16 bits raw values.
+
+    The table is computed once, on first use.
+    """
+    global _TEMPERATURE_TABLE  # pylint: disable=global-statement
+    if _TEMPERATURE_TABLE is None:
+        with _TABLE_LOCK:
+            if _TEMPERATURE_TABLE is None:
+                table = array('d', (_raw_to_temperature(raw_value) for raw_value in range(0x10000)))
+                if numpy is not None:
+                    table = numpy.frombuffer(table, dtype=numpy.float64)
+                _TEMPERATURE_TABLE = table
+    return _TEMPERATURE_TABLE
+
+
+def decode_battery(raw):
+    """Battery level in %."""
+    return ord(raw)
+
+
+def decode_air_temperature(raw):
+    """Calibrated air temperature in degrees Celsius."""
+    return round(unpack("<f", raw)[0], 1)
+
+
+def decode_soil_temperature(raw):
+    """Soil temperature in degrees Celsius, from the raw 16 bits value."""
+    return float(temperature_table()[unpack("<H", raw)[0]])
+
+
+def decode_moisture(raw):
+    """Calibrated moisture in %."""
+    return round(unpack("<f", raw)[0])
+
+
+def decode_light(raw):
+    """Calibrated light, multiply by 54 to get lux."""
+    return round(unpack("<f", raw)[0], 2)
+
+
+def decode_conductivity(raw):
+    """Raw soil conductivity."""
+    return unpack("<H", raw)[0]
+
+
+def decode_name(raw):
+    """Name of the sensor, without its 3 trailing bytes, or None if it can't be decoded."""
+    try:
+        return ''.join(chr(n) for n in raw[:-3])
+    except TypeError:
+        return None
+
+
+def decode_firmware(raw):
+    """Firmware version, from a revision such as b'2015-07-07_hawaii-1.1.0', or the whole revision in another format."""
+    revision = raw.decode("utf-8", "replace").strip('\x00')
+    try:
+        return revision.split('_')[1].split('-')[1]
+    except IndexError:
+        return revision or None
+
+
+def decode_records(data, fields, temperatures=()):
+    """Decode a block of little-endian unsigned 16 bits records into columns.
+
+    fields names the values of a record, in order. The fields listed in
+    temperatures are converted to degrees Celsius, the others are kept raw.
+    Return a dict field -> column (a NumPy array or an array.array).
+    """
+    size = 2 * len(fields)
+    count = len(data) // size
+    if numpy is not None:
+        records = numpy.frombuffer(data, dtype=numpy.dtype([(field, '<u2') for field in fields]), count=count)
+        columns = dict((field, records[field]) for field in fields)
+        table = temperature_table()
+        for field in temperatures:
+            columns[field] = table[columns[field]]
+        return columns
+
+    raw = array('H')
+    raw.frombytes(data[:count * size])
+    if sys.byteorder != 'little':
+        raw.byteswap()
+    columns = dict((field, raw[num::len(fields)]) for num, field in enumerate(fields))
+    table = temperature_table()
+    for field in temperatures:
+        columns[field] = array('d', [table[raw_value] for raw_value in columns[field]])
+    return columns
@@ -0,0 +1,295 @@
+"""
+In-memory backends answering like Parrot Flower Power & Pot sensors.
+
+Useful to exercise the pollers without radios:
+
+    FakeBackend.add_sensor('A0:14:3D:00:00:01', moisture=25)
+    poller = ParrotFlowerPoller('A0:14:3D:00:00:01', FakeBackend)
+
+SimulatedBackend adds the latencies and failures of real radios, for
+benchmarks.
+"""
+
+import random
+from struct import pack, unpack
+from threading import Event, Lock
+import time
+from btlewrap.base import AbstractBackend, BluetoothBackendException
+
+from parrot_flower.parrot_flower_history import HISTORY_RECORD, _FRAME_DATA_SIZE, \
+    _HANDLE_HISTORY_NB_ENTRIES, _HANDLE_HISTORY_LAST_ENTRY_INDEX, _HANDLE_HISTORY_TRANSFER_START_INDEX, \
+    _HANDLE_HISTORY_SESSION_PERIOD, _HANDLE_UPLOAD_RX_STATUS, _RX_STATUS_RECEIVING
+from parrot_flower.parrot_flower_decoder import temperature_table
+from parrot_flower.parrot_flower_poller import \
+    _HANDLE_READ_BATTERY, _HANDLE_READ_VERSION, _HANDLE_READ_NAME, \
+    _HANDLE_READ_AIR_TEMPERATURE, _HANDLE_READ_SOIL_TEMPERATURE, _HANDLE_READ_MOISTURE, \
+    _HANDLE_READ_LIGHT, _HANDLE_READ_CONDUCTIVITY, _HANDLE_LIVE_MEASURE_PERIOD, _ENABLE_NOTIFICATIONS
+
+
+def encode_temperature(value):
+    """Return the raw 16 bits value decoding to the temperature closest to value."""
+    # the conversion polynomial is increasing, bisect on the raw value
+    table = temperature_table()
+    low, high = 0, 0xFFFF
+    while low < high:
+        middle = (low + high) // 2
+        if table[middle] < value:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+def sensor_handles(name='Flower power', firmware='1.1.0', battery=80, air_temperature=20.0,
+                   soil_temperature=18.0, moisture=30, light=10.0, conductivity=300):
+    """Return the handle -> payload map of a sensor with the given values."""
+    return {
+        _HANDLE_READ_NAME: name.encode("utf-8") + b"\x00\x00\x00",
+        _HANDLE_READ_VERSION: "2015-07-07_hawaii-{}".format(firmware).encode("utf-8"),
+        _HANDLE_READ_BATTERY: bytes([battery]),
+        _HANDLE_READ_AIR_TEMPERATURE: pack("<f", air_temperature),
+        _HANDLE_READ_SOIL_TEMPERATURE: pack("<H", encode_temperature(soil_temperature)),
+        _HANDLE_READ_MOISTURE: pack("<f", moisture),
+        _HANDLE_READ_LIGHT: pack("<f", light),
+        _HANDLE_READ_CONDUCTIVITY: pack("<H", conductivity),
+    }
+
+
+# pseudo handle holding the history of a sensor
+_HISTORY = -1
+
+
+class FakeBackend(AbstractBackend):
+    """
+    Backend reading the sensors registered with add_sensor().
+
+    The sensors are shared by all the instances, like real sensors are
+    shared by all the adapters.
+    """
+
+    _sensors = {}
+    _rssi = {}
+    _sensors_lock = Lock()
+
+    def __init__(self, adapter='hci0', address_type='public', **kwargs):
+        super(FakeBackend, self).__init__(adapter, address_type, **kwargs)
+        self._mac = None
+        self._upload = []
+        self._notified = set()  # value handles with notifications enabled
+        self._next_live = None
+
+    @classmethod
+    def add_sensor(cls, mac, rssi=-70, **values):
+        """Add a sensor, values are the keyword arguments of sensor_handles().
+
+        rssi is the signal strength of its advertisements, in dBm.
+        """
+        with cls._sensors_lock:
+            cls._sensors[mac.upper()] = sensor_handles(**values)
+            cls._rssi[mac.upper()] = rssi
+
+    @classmethod
+    def add_history(cls, mac, records, period=900):
+        """Set the history of a sensor, records are tuples of raw HISTORY_RECORD values.
+
+        The last record gets index len(records).
+        """
+        with cls._sensors_lock:
+            handles = cls._sensors[mac.upper()]
+            handles[_HANDLE_HISTORY_NB_ENTRIES] = pack("<H", len(records))
+            handles[_HANDLE_HISTORY_LAST_ENTRY_INDEX] = pack("<I", len(records))
+            handles[_HANDLE_HISTORY_SESSION_PERIOD] = pack("<H", period)
+            handles[_HISTORY] = b"".join(HISTORY_RECORD.pack(*record) for record in records)
+
+    @classmethod
+    def remove_sensor(cls, mac):
+        """Remove a sensor, it can no longer be connected."""
+        with cls._sensors_lock:
+            cls._sensors.pop(mac.upper(), None)
+            cls._rssi.pop(mac.upper(), None)
+
+    @classmethod
+    def clear(cls):
+        """Remove all the sensors."""
+        with cls._sensors_lock:
+            cls._sensors.clear()
+            cls._rssi.clear()
+
+    def connect(self, mac):
+        if mac.upper() not in self._sensors:
+            raise BluetoothBackendException("Could not connect to sensor %s" % mac)
+        self._mac = mac.upper()
+
+    def disconnect(self):
+        self._mac = None
+        self._upload = []
+        self._notified = set()
+        self._next_live = None
+
+    def read_handle(self, handle):
+        if self._mac is None:
+            raise BluetoothBackendException("Not connected")
+        return self._sensors.get(self._mac, {}).get(handle)
+
+    def write_handle(self, handle, value):
+        if self._mac is None:
+            raise BluetoothBackendException("Not connected")
+        with self._sensors_lock:
+            handles = self._sensors.get(self._mac, {})
+            handles[handle] = bytes(value)
+            if bytes(value) == _ENABLE_NOTIFICATIONS:
+                self._notified.add(handle - 1)
+            if handle == _HANDLE_UPLOAD_RX_STATUS and value[0] == _RX_STATUS_RECEIVING:
+                self._start_upload(handles)
+        return True
+
+    def _start_upload(self, handles):
+        """Prepare the frames of the history file from the transfer start index."""
+        start = unpack("<I", handles[_HANDLE_HISTORY_TRANSFER_START_INDEX])[0]
+        data = handles.get(_HISTORY, b"")[(start - 1) * HISTORY_RECORD.size:]
+        self._upload = [pack("<HI", 0, len(data))]
+        for num in range(0, len(data), _FRAME_DATA_SIZE):
+            self._upload.append(pack("<H", len(self._upload)) + data[num:num + _FRAME_DATA_SIZE])
+
+    def wait_for_notification(self, handle, delegate, notification_timeout):
+        frames, self._upload = self._upload, []
+        for frame in frames:
+            delegate.handleNotification(handle - 1, frame)
+        if frames or self._mac is None:
+            return bool(frames)
+        # like btlewrap, enable the notifications of handle
+        self._notified.add(handle - 1)
+        with self._sensors_lock:
+            handles = dict(self._sensors.get(self._mac, {}))
+        period = handles.get(_HANDLE_LIVE_MEASURE_PERIOD, b"\x00")[0]
+        if not period:
+            self._next_live = None
+            return False
+        # in live mode the sensor notifies its measurements every period seconds
+        now = time.time()
+        if self._next_live is None:
+            self._next_live = now + period
+        if self._next_live - now > notification_timeout:
+            time.sleep(notification_timeout)
+            return False
+        time.sleep(max(0, self._next_live - now))
+        self._next_live += period
+        notified = False
+        for value_handle in sorted(self._notified):
+            if value_handle in handles:
+                delegate.handleNotification(value_handle, handles[value_handle])
+                notified = True
+        return notified
+
+    def check_backend(self):
+        return True
+
+    @staticmethod
+    def is_available():
+        return True
+
+    @staticmethod
+    def scan_for_devices(timeout, adapter='hci0'):
+        return [(mac, name) for mac, name, _ in FakeBackend._advertisements()]
+
+    @staticmethod
+    def _advertisements():
+        """Return (mac, name, rssi) for all the sensors."""
+        with FakeBackend._sensors_lock:
+            return [(mac, handles[_HANDLE_READ_NAME][:-3].decode("utf-8"), FakeBackend._rssi.get(mac))
+                    for mac, handles in FakeBackend._sensors.items()]
+
+    @staticmethod
+    def iter_devices(timeout, adapter='hci0'):
+        """Yield (mac, name, rssi) for all the sensors, like a streaming scan."""
+        for advertisement in FakeBackend._advertisements():
+            yield advertisement
+
+
+class SimulatedBackend(FakeBackend):
+    """
+    FakeBackend with radio latencies, random failures and hangs.
+
+    The settings are shared by all the instances, change them with configure().
+    """
+
+    connect_latency = 1.0
+    read_latency = 0.1
+    failure_rate = 0.0
+    hang_probability = 0.0
+    hang_time = 60.0
+    advertising_interval = 1.0
+
+    def __init__(self, adapter='hci0', address_type='public', **kwargs):
+        super(SimulatedBackend, self).__init__(adapter, address_type, **kwargs)
+        self._cancelled = Event()
+
+    @classmethod
+    def configure(cls, **settings):
+        """Change the latencies (seconds), failure_rate, hang_probability, hang_time or advertising_interval."""
+        for name, value in settings.items():
+            if not hasattr(cls, name) or name.startswith('_'):
+                raise ValueError("Unknown setting %s" % name)
+            setattr(cls, name, value)
+
+    @classmethod
+    def populate(cls, count, prefix='A0:14:3D'):
+        """Add count sensors with realistic random values, return their macs."""
+        macs = []
+        for num in range(count):
+            mac = '{}:{:02X}:{:02X}:{:02X}'.format(prefix, (num >> 16) & 0xFF, (num >> 8) & 0xFF, num & 0xFF)
+            cls.add_sensor(mac,
+                           name='Flower power {:04X}'.format(num & 0xFFFF),
+                           battery=random.randint(5, 100),
+                           air_temperature=random.uniform(5.0, 35.0),
+                           soil_temperature=random.uniform(5.0, 30.0),
+                           moisture=random.uniform(5.0, 60.0),
+                           light=random.uniform(0.1, 40.0),
+                           conductivity=random.randint(0, 1200),
+                           rssi=random.randint(-95, -50))
+            macs.append(mac)
+        return macs
+
+    @staticmethod
+    def _latency(base):
+        """Sleep about base seconds."""
+        if base > 0:
+            time.sleep(random.uniform(0.5 * base, 1.5 * base))
+
+    def connect(self, mac):
+        self._latency(self.connect_latency)
+        if random.random() < self.hang_probability and self._cancelled.wait(self.hang_time):
+            raise BluetoothBackendException("Connection to %s cancelled" % mac)
+        if random.random() < self.failure_rate:
+            raise BluetoothBackendException("Simulated failure connecting to %s" % mac)
+        super(SimulatedBackend, self).connect(mac)
+
+    @classmethod
+    def iter_devices(cls, timeout, adapter='hci0'):
+        """Yield the sensors in the order their first advertisement arrives, within timeout seconds."""
+        start = time.time()
+        arrivals = sorted((random.uniform(0, cls.advertising_interval), mac, name, rssi)
+                          for mac, name, rssi in cls._advertisements())
+        for arrival, mac, name, rssi in arrivals:
+            if arrival > timeout:
+                break
+            delay = start + arrival - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            # each adapter receives the sensor with its own, stable, signal strength
+            yield mac, name, rssi + random.Random(mac + adapter).randint(-10, 10)
+
+    def wait_for_notification(self, handle, delegate, notification_timeout):
+        if random.random() < self.failure_rate:
+            raise BluetoothBackendException("Simulated disconnection from %s" % self._mac)
+        return super(SimulatedBackend, self).wait_for_notification(handle, delegate, notification_timeout)
+
+    def cancel(self):
+        """Abort a hung connection, like a killed helper process."""
+        self._cancelled.set()
+
+    def read_handle(self, handle):
+        self._latency(self.read_latency)
+        if random.random() < self.failure_rate:
+            raise BluetoothBackendException("Simulated failure reading from %s" % self._mac)
+        return super(SimulatedBackend, self).read_handle(handle)
@@ -0,0 +1,194 @@
+"""
+Download the measurements history stored by Parrot Flower Power & Pot sensors.
+
+The sensor logs its measurements every session period. The history is read
+as a file sent through the upload service: the transfer starts at a given
+entry index, so only the entries logged since the previous download are
+transferred when the last downloaded index is remembered.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import logging
+import shelve
+from struct import pack, unpack, Struct
+from threading import Lock
+import time
+from btlewrap.base import BluetoothBackendException
+
+from parrot_flower.parrot_flower_decoder import decode_records
+
+_LOGGER = logging.getLogger(__name__)
+
+# Handles of the history (39e1fc0x) and upload (39e1fb0x) characteristics.
+# They may differ between firmware versions, check them with
+# sudo gatttool --device=A0:14:3D:XX:XX:XX --char-desc --adapter=hci0
+_HANDLE_HISTORY_NB_ENTRIES = 0x6A
+_HANDLE_HISTORY_LAST_ENTRY_INDEX = 0x6D
+_HANDLE_HISTORY_TRANSFER_START_INDEX = 0x70
+_HANDLE_HISTORY_SESSION_PERIOD = 0x79
+_HANDLE_UPLOAD_TX_BUFFER = 0x8B
+_HANDLE_UPLOAD_RX_STATUS = 0x93
+
+_RX_STATUS_STANDBY = 0
+_RX_STATUS_RECEIVING = 1
+
+# each upload notification is a 16 bits frame index and 18 bytes of data,
+# frame 0 holds the length of the file
+_FRAME_DATA_SIZE = 18
+
+# an entry holds the raw values of air temperature, soil temperature, light,
+# moisture and conductivity, the temperatures are converted by decode_records
+HISTORY_FIELDS = ('air_temperature', 'soil_temperature', 'light', 'moisture', 'conductivity')
+HISTORY_TEMPERATURES = ('air_temperature', 'soil_temperature')
+HISTORY_RECORD = Struct("<" + "H" * len(HISTORY_FIELDS))
+
+HistoryEntry = namedtuple('HistoryEntry', ('index', 'timestamp') + HISTORY_FIELDS)
+
+
+class HistoryBlock(namedtuple('HistoryBlock', ('mac', 'first_index', 'last_index', 'period', 'read_time', 'data'))):
+    """
+    Entries downloaded from a sensor, data holds the raw HISTORY_RECORD entries.
+    """
+    __slots__ = ()
+
+    def nb_entries(self):
+        """Return the number of entries in the block."""
+        return len(self.data) // HISTORY_RECORD.size
+
+    def timestamp(self, index):
+        """Return the approximate time an entry was logged.
+
+        The sensor has no clock, the time is derived from the entry index,
+        the session period and the time of the download.
+        """
+        return self.read_time - timedelta(seconds=(self.last_index - index) * self.period)
+
+    def columns(self):
+        """Return the decoded entries as a dict field -> column, see decode_records()."""
+        return decode_records(self.data, HISTORY_FIELDS, HISTORY_TEMPERATURES)
+
+    def entries(self):
+        """Return the decoded entries as a list of HistoryEntry."""
+        columns = self.columns()
+        values = zip(*[columns[field].tolist() for field in HISTORY_FIELDS])
+        return [HistoryEntry(self.first_index + num, self.timestamp(self.first_index + num), *entry)
+                for num, entry in enumerate(values)]
+
+
+class HistoryCursors(object):
+    """
+    Persistent store of the index of the last entry downloaded from each sensor.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = Lock()
+
+    def get(self, mac):
+        """Return the last downloaded index of a sensor, or None."""
+        with self._lock:
+            database = shelve.open(self._filename)
+            try:
+                return database.get(mac.upper())
+            finally:
+                database.close()
+
+    def set(self, mac, index):
+        """Remember the last downloaded index of a sensor."""
+        with self._lock:
+            database = shelve.open(self._filename)
+            try:
+                database[mac.upper()] = index
+            finally:
+                database.close()
+
+
+class _UploadDelegate(object):
+    """
+    Collect the frames of an upload notified by the sensor.
+    """
+
+    def __init__(self):
+        self.frames = {}
+        self.length = None
+
+    def handleNotification(self, handle, data):  # pylint: disable=invalid-name,unused-argument
+        """Called by the backend for each notification."""
+        if len(data) < 2:
+            return
+        index = unpack("<H", data[:2])[0]
+        if index == 0:
+            self.length = unpack("<I", data[2:6])[0]
+        else:
+            self.frames[index] = bytes(data[2:2 + _FRAME_DATA_SIZE])
+
+    def complete(self):
+        """Check if all the frames of the file were received."""
+        return self.length is not None and \
+            len(self.frames) * _FRAME_DATA_SIZE >= self.length
+
+    def data(self):
+        """Return the content of the file."""
+        return b"".join(self.frames[index] for index in sorted(self.frames))[:self.length]
+
+
+class ParrotFlowerHistory(object):
+    """
+    Incremental download of the history of a sensor.
+    """
+
+    def __init__(self, poller, cursors=None, transfer_timeout=120):
+        """
+        Download the history of the sensor read by poller (a ParrotFlowerPoller).
+
+        If cursors (a HistoryCursors) is given, each sync only downloads the
+        entries logged since the previous one.
+        """
+        self._poller = poller
+        self._cursors = cursors
+        self._transfer_timeout = transfer_timeout
+
+    def download(self, start_index=None):
+        """Download the entries from start_index (the oldest one if None)."""
+        mac = self._poller.mac()
+        with self._poller.lock:
+            with self._poller._connect() as connection:  # pylint: disable=protected-access
+                nb_entries = unpack("<H", self._read(connection, _HANDLE_HISTORY_NB_ENTRIES))[0]
+                last_index = unpack("<I", self._read(connection, _HANDLE_HISTORY_LAST_ENTRY_INDEX))[0]
+                period = unpack("<H", self._read(connection, _HANDLE_HISTORY_SESSION_PERIOD))[0]
+                first_available = last_index - nb_entries + 1
+                if start_index is None or start_index < first_available:
+                    start_index = first_available
+                read_time = datetime.now()
+                if nb_entries == 0 or start_index > last_index:
+                    return HistoryBlock(mac, start_index, last_index, period, read_time, b"")
+
+                _LOGGER.debug('Downloading history of %s from entry %d to %d', mac, start_index, last_index)
+                connection.write_handle(_HANDLE_HISTORY_TRANSFER_START_INDEX, pack("<I", start_index))
+                connection.write_handle(_HANDLE_UPLOAD_RX_STATUS, bytes([_RX_STATUS_RECEIVING]))
+                delegate = _UploadDelegate()
+                deadline = time.time() + self._transfer_timeout
+                while not delegate.complete():
+                    if time.time() > deadline:
+                        raise BluetoothBackendException("History transfer from sensor %s timed out" % mac)
+                    connection.wait_for_notification(_HANDLE_UPLOAD_TX_BUFFER + 1, delegate, 5.0)
+                connection.write_handle(_HANDLE_UPLOAD_RX_STATUS, bytes([_RX_STATUS_STANDBY]))
+
+        return HistoryBlock(mac, start_index, last_index, period, read_time, delegate.data())
+
+    def sync(self):
+        """Download the entries logged since the previous sync and advance the cursor."""
+        mac = self._poller.mac()
+        last = self._cursors.get(mac) if self._cursors is not None else None
+        block = self.download(None if last is None else last + 1)
+        if self._cursors is not None and block.nb_entries():
+            self._cursors.set(mac, block.first_index + block.nb_entries() - 1)
+        return block
+
+    def _read(self, connection, handle):
+        """Read a handle, raise if the sensor does not answer."""
+        value = connection.read_handle(handle)
+        if not value:
+            raise BluetoothBackendException("Could not read data from sensor %s" % self._poller.mac())
+        return value
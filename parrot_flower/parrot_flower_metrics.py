@@ -0,0 +1,148 @@
+"""
+Low-overhead counters and histograms of the polling hot path.
+
+Durations are recorded in fixed buckets, a snapshot can be written as JSON
+or in the Prometheus text format. The pollers record in METRICS unless
+they are given another Metrics.
+"""
+
+from bisect import bisect_left
+import json
+import os
+from threading import Lock
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in fixed buckets.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """Record a value."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def mean(self):
+        """Return the mean of the values, 0 if there are none."""
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, fraction):
+        """Return the upper bound of the bucket holding the given quantile."""
+        rank = fraction * self.count
+        total = 0
+        for num, count in enumerate(self.counts):
+            total += count
+            if count and total >= rank:
+                return self.bounds[num] if num < len(self.bounds) else float('inf')
+        return 0.0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    """
+    A set of named counters and histograms, with labels.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._lock = Lock()
+
+    def increment(self, name, amount=1, **labels):
+        """Add amount to a counter."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        """Record a value in a histogram."""
+        key = _key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def counter(self, name, **labels):
+        """Return the value of a counter, or the sum of the counters matching the labels."""
+        wanted = set(labels.items())
+        with self._lock:
+            return sum(value for (counter, counter_labels), value in self._counters.items()
+                       if counter == name and wanted <= set(counter_labels))
+
+    def histogram(self, name, **labels):
+        """Return a histogram merging the histograms matching the labels."""
+        wanted = set(labels.items())
+        merged = Histogram()
+        with self._lock:
+            for (histogram_name, histogram_labels), histogram in self._histograms.items():
+                if histogram_name == name and wanted <= set(histogram_labels):
+                    merged.counts = [total + count for total, count in zip(merged.counts, histogram.counts)]
+                    merged.sum += histogram.sum
+                    merged.count += histogram.count
+        return merged
+
+    def snapshot(self):
+        """Return all the metrics as a JSON serializable dict."""
+        with self._lock:
+            return {
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self._counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), 'count': histogram.count,
+                                'sum': histogram.sum, 'buckets': list(histogram.bounds) + ['+Inf'],
+                                'counts': list(histogram.counts)}
+                               for (name, labels), histogram in sorted(self._histograms.items())],
+            }
+
+    def prometheus(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        snapshot = self.snapshot()
+        for counter in snapshot['counters']:
+            lines.append('{}{} {}'.format(counter['name'], _labels(counter['labels']), counter['value']))
+        for histogram in snapshot['histograms']:
+            total = 0
+            for bound, count in zip(histogram['buckets'], histogram['counts']):
+                total += count
+                labels = dict(histogram['labels'], le=str(bound))
+                lines.append('{}_bucket{} {}'.format(histogram['name'], _labels(labels), total))
+            lines.append('{}_sum{} {}'.format(histogram['name'], _labels(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(histogram['name'], _labels(histogram['labels']), histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Write a snapshot atomically, in the Prometheus format if filename ends with .prom, JSON otherwise."""
+        if filename.endswith('.prom'):
+            content = self.prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=1)
+        temporary = filename + '.tmp'
+        with open(temporary, 'w') as output:
+            output.write(content)
+        os.replace(temporary, filename)
+
+
+def _labels(labels):
+    """Format labels for Prometheus."""
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in sorted(labels.items())) + '}'
+
+
+METRICS = Metrics()
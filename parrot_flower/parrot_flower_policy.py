@@ -0,0 +1,81 @@
+"""
+Adapt the polling interval of each sensor to its battery and radio cost.
+
+A poll costs battery in proportion to the time spent connected to the
+sensor, and a sensor which needs several attempts costs that much more.
+Sensors with a low battery, or whose polls cost more than those of the
+other sensors, are polled less often.
+"""
+
+import statistics
+
+
+class BatteryPolicy(object):
+    """
+    Polling interval of each sensor, from its battery level and the cost of its polls.
+
+    The cost of a poll is the time spent in read sessions times the number
+    of attempts it took, smoothed over the last polls. The interval is
+    multiplied by the ratio of the cost of the sensor to the median cost of
+    the fleet, and by battery_low / battery when the battery is below
+    battery_low percent, then kept between min_interval and max_interval.
+    """
+
+    def __init__(self, interval, min_interval=None, max_interval=None, battery_low=30, smoothing=0.3):
+        """
+        interval is the nominal polling interval in seconds, min_interval
+        (interval if None) and max_interval (4 times interval if None) its
+        bounds. smoothing is the weight of the last poll in the average cost.
+        """
+        self._interval = interval
+        self._min_interval = min_interval if min_interval is not None else interval
+        self._max_interval = max_interval if max_interval is not None else 4 * interval
+        self._battery_low = battery_low
+        self._smoothing = smoothing
+        self._costs = {}
+        self._batteries = {}
+        self._failed = {}  # failed attempts since the last successful poll
+
+
+    def failure(self, mac):
+        """Record a failed poll, it adds to the cost of the next successful one."""
+        self._failed[mac] = self._failed.get(mac, 0) + 1
+
+
+    def success(self, mac, battery, radio_time):
+        """Record a successful poll which spent radio_time seconds connected, return the next interval."""
+        attempts = 1 + self._failed.pop(mac, 0)
+        if battery is not None:
+            self._batteries[mac] = battery
+        # a poll answered from the cache did not use the radio, it says nothing about the cost
+        if radio_time > 0:
+            cost = radio_time * attempts
+            last = self._costs.get(mac)
+            self._costs[mac] = cost if last is None else self._smoothing * cost + (1 - self._smoothing) * last
+        return self.interval(mac)
+
+
+    def cost(self, mac):
+        """Return the average cost of the polls of a sensor, in seconds, or None."""
+        return self._costs.get(mac)
+
+
+    def interval(self, mac):
+        """Return the polling interval of a sensor, in seconds."""
+        factor = 1.0
+        battery = self._batteries.get(mac)
+        if battery is not None and battery < self._battery_low:
+            factor *= self._battery_low / float(max(battery, 1))
+        cost = self._costs.get(mac)
+        if cost is not None:
+            median = statistics.median(self._costs.values())
+            if median > 0:
+                factor *= cost / median
+        return min(max(self._interval * factor, self._min_interval), self._max_interval)
+
+
+    def forget(self, mac):
+        """Forget a sensor."""
+        self._costs.pop(mac, None)
+        self._batteries.pop(mac, None)
+        self._failed.pop(mac, None)
@@ -2,11 +2,17 @@
 Read data from Parrot Flower Power & Pot sensor.
 """
 
+from collections import deque, namedtuple
 from datetime import datetime, timedelta
-from struct import unpack
 import logging
-from threading import Lock
-from btlewrap.base import BluetoothInterface, BluetoothBackendException
+from functools import partial
+from threading import Condition, Event, Lock, RLock, Thread
+import time
+from time import perf_counter
+from btlewrap.base import BluetoothBackendException
+
+from parrot_flower import parrot_flower_decoder as decoder
+from parrot_flower.parrot_flower_metrics import METRICS
 
 # sudo gatttool --device=A0:14:3D:XX:XX:XX --char-desc -a 0x03 --adapter=hci0
 # sudo node node_modules/noble/examples/peripheral-explorer.js a0:14:3d:xx:xx:xx
@@ -20,6 +26,12 @@ _HANDLE_READ_MOISTURE = 0x3F
 _HANDLE_READ_LIGHT = 0x47
 _HANDLE_READ_CONDUCTIVITY = 0x29
 
+# seconds between two notifications of the live measurements, 0 to stop them.
+# It may differ between firmware versions, like the history handles.
+_HANDLE_LIVE_MEASURE_PERIOD = 0x39
+# written to the client characteristic configuration descriptor, just after a value handle
+_ENABLE_NOTIFICATIONS = b"\x01\x00"
+
 
 P_AIR_TEMPERATURE = "air_temperature"
 P_SOIL_TEMPERATURE = "soil_temperature"
@@ -28,107 +40,437 @@ P_MOISTURE = "moisture"
 P_CONDUCTIVITY = "conductivity"
 P_BATTERY = "battery"
 
+# measurements read by default, in reading order
+MEASUREMENTS = (P_BATTERY, P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, P_MOISTURE, P_LIGHT, P_CONDUCTIVITY)
+# measurements notified in live mode
+LIVE_MEASUREMENTS = (P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, P_MOISTURE, P_LIGHT, P_CONDUCTIVITY)
+
+_PARAMETER_DECODERS = {
+    P_BATTERY: decoder.decode_battery,
+    P_AIR_TEMPERATURE: decoder.decode_air_temperature,
+    P_SOIL_TEMPERATURE: decoder.decode_soil_temperature,
+    P_MOISTURE: decoder.decode_moisture,
+    P_LIGHT: decoder.decode_light,
+    P_CONDUCTIVITY: decoder.decode_conductivity,
+}
+
+_PARAMETER_HANDLES = {
+    P_BATTERY: _HANDLE_READ_BATTERY,
+    P_AIR_TEMPERATURE: _HANDLE_READ_AIR_TEMPERATURE,
+    P_SOIL_TEMPERATURE: _HANDLE_READ_SOIL_TEMPERATURE,
+    P_MOISTURE: _HANDLE_READ_MOISTURE,
+    P_LIGHT: _HANDLE_READ_LIGHT,
+    P_CONDUCTIVITY: _HANDLE_READ_CONDUCTIVITY,
+}
+
 _LOGGER = logging.getLogger(__name__)
 
 
+class BluetoothTimeout(BluetoothBackendException):
+    """
+    A connection or a read session did not complete before its deadline.
+    """
+
+# btlewrap serializes all the connections of the process with a single lock,
+# we only serialize the connections made through the same adapter so that
+# sensors can be polled in parallel through several adapters.
+_ADAPTER_LOCKS = {}
+_ADAPTER_LOCKS_LOCK = Lock()
+
+
+def adapter_lock(adapter):
+    """Return the lock serializing the connections of an adapter.
+
+    Hold it to use the adapter for something else than a poll, a scan for example.
+    """
+    with _ADAPTER_LOCKS_LOCK:
+        return _ADAPTER_LOCKS.setdefault(adapter, RLock())
+
+
+class _AdapterConnection(object):
+    """
+    Context manager connecting a backend to a sensor, holding the adapter lock.
+    """
+
+    def __init__(self, backend, mac, lock, timeout=-1, locked=None):
+        """
+        Wait at most timeout seconds for the lock (-1 waits forever), then call locked if given.
+        """
+        self._backend = backend
+        self._mac = mac
+        self._lock = lock
+        self._timeout = timeout
+        self._locked = locked
+
+    def __enter__(self):
+        if not self._lock.acquire(timeout=self._timeout):
+            raise BluetoothTimeout("Adapter busy, could not connect to %s" % self._mac)
+        if self._locked is not None:
+            self._locked()
+        try:
+            self._backend.connect(self._mac)
+        except:
+            self._lock.release()
+            raise
+        return self._backend
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            self._backend.disconnect()
+        finally:
+            self._lock.release()
+
+
+def _cancel(backend):
+    """Abort, from another thread, the calls blocked in a backend."""
+    cancel = getattr(backend, 'cancel', None)
+    if cancel is not None:
+        cancel()
+        return
+    # bluepy blocks reading the output of its helper process, the call fails when it is killed
+    helper = getattr(getattr(backend, '_peripheral', None), '_helper', None)
+    if helper is not None:
+        try:
+            helper.kill()
+        except OSError:
+            pass
+    # pygatt blocks in its adapter, stopping it fails the pending calls
+    adapter = getattr(backend, '_adapter', None)
+    if adapter is not None and hasattr(adapter, 'stop'):
+        try:
+            adapter.stop()
+        except Exception as error:  # pylint: disable=broad-except
+            _LOGGER.debug('Could not stop the pygatt adapter: %s', error)
+
+
+class _Session(Thread):
+    """
+    A read session running in its own thread, so that it can be abandoned when it hangs.
+
+    locked is set once the session holds the adapter lock or is over,
+    connected once the sensor is connected or the session is over,
+    cancelled tells an abandoned session to stop as soon as possible.
+    """
+
+    def __init__(self, target, name):
+        Thread.__init__(self, name=name)
+        self.daemon = True
+        self._session = target
+        self.locked = Event()
+        self.locked_time = None
+        self.connected = Event()
+        self.cancelled = Event()
+        self.result = None
+        self.error = None
+
+    def lock_acquired(self):
+        """Record that the session holds the adapter lock."""
+        self.locked_time = perf_counter()
+        self.locked.set()
+
+    def run(self):
+        try:
+            self.result = self._session(self)
+        except BaseException as error:  # pylint: disable=broad-except
+            self.error = error
+        finally:
+            self.locked.set()
+            self.connected.set()
+
+
+class ParrotFlowerSnapshot(namedtuple('ParrotFlowerSnapshot', ('mac', 'timestamp', 'name', 'firmware') + MEASUREMENTS)):
+    """
+    The data read from a sensor during one read session.
+
+    Values which were not read in the session are None.
+    """
+    __slots__ = ()
+
+    def measurements(self):
+        """Return the measurements which were read as a dict."""
+        return dict((parameter, getattr(self, parameter)) for parameter in MEASUREMENTS
+                    if getattr(self, parameter) is not None)
+
+ParrotFlowerSnapshot.__new__.__defaults__ = (None,) * (len(ParrotFlowerSnapshot._fields) - 2)
+
+LiveReading = namedtuple('LiveReading', ('mac', 'timestamp', 'parameter', 'value'))
+
+
 class ParrotFlowerPoller(object):
     """"
     A class to read data from Parrot plant sensors.
     """
 
-    def __init__(self, mac, backend, cache_timeout=600, adapter='hci0'):
+    def __init__(self, mac, backend, cache_timeout=600, adapter='hci0', metadata_timeout=7*24*3600,
+                 parameter_timeouts=None, metrics=METRICS, ble_timeout=10, session_timeout=30,
+                 backend_options=None, shared_cache=None, lock_timeout=None):
         """
         Initialize a Parrot Flower & Pot Poller for the given MAC address.
+
+        The name and firmware version rarely change, they are cached for
+        metadata_timeout seconds.
+        parameter_timeouts maps measurements to their own cache timeout in
+        seconds, the other measurements use cache_timeout.
+        The timings and failures are recorded in metrics.
+        A read session fails with BluetoothTimeout if the sensor is not
+        connected within ble_timeout seconds or if the session lasts more than
+        session_timeout seconds, the hung connection is then cancelled.
+        These deadlines start once the adapter is free: a session first waits
+        for the other sessions of its adapter, at most lock_timeout seconds
+        (2 * session_timeout if None).
+        backend_options are passed to the backend constructor.
+        If shared_cache (a SharedCache) is given, the fresh readings stored
+        there by other processes are used instead of reading the sensor, and
+        the readings of this poller are stored there.
         """
 
         self._mac = mac
-        self._bt_interface = BluetoothInterface(backend=backend, adapter=adapter)
+        self._adapter = adapter
+        self._backend_class = backend
+        self._backend_options = dict(backend_options or {})
+        self._backend = self._new_backend()
         self._cache = None
         self._cache_timeout = timedelta(seconds=cache_timeout)
+        self._parameter_timeouts = dict((parameter, self._cache_timeout) for parameter in MEASUREMENTS)
+        for parameter, timeout in (parameter_timeouts or {}).items():
+            self._parameter_timeouts[parameter] = timedelta(seconds=timeout)
+        self._read_times = {}
+        self._retry_after = None
         self._last_read = None
+        self._metadata = None
+        self._metadata_timeout = timedelta(seconds=metadata_timeout)
         self._fw_last_read = None
-        self.ble_timeout = 10
+        self._shared_cache = shared_cache
+        self.ble_timeout = ble_timeout
+        self.session_timeout = session_timeout
+        self.lock_timeout = lock_timeout if lock_timeout is not None else 2 * session_timeout
+        # total seconds spent in read sessions, a measure of the battery used by the polls
+        self.radio_time = 0.0
         self.lock = Lock()
+        self._metrics = metrics
+
+
+    def mac(self):
+        """Return the MAC address of the sensor."""
+        return self._mac
+
+
+    def adapter(self):
+        """Return the bluetooth adapter used to connect to the sensor."""
+        return self._adapter
+
+
+    def _new_backend(self):
+        """Return a new, checked, instance of the backend."""
+        backend = self._backend_class(adapter=self._adapter, **self._backend_options)
+        backend.check_backend()
+        return backend
+
+
+    def _connect(self):
+        """Return a context manager connected to the sensor."""
+        return _AdapterConnection(self._backend, self._mac, adapter_lock(self._adapter))
 
 
     def name(self):
         """Return the name of the sensor."""
-        with self._bt_interface.connect(self._mac) as connection:
-            name = connection.read_handle(_HANDLE_READ_NAME)  # pylint: disable=no-member
-
-        if not name:
-            raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-        return ''.join(chr(n) for n in name[:-3])
+        return self._read_metadata()[0]
 
 
     def firmware_version(self):
         """Return the firmware version."""
-        with self._bt_interface.connect(self._mac) as connection:
-            firmwareRevision = connection.read_handle(_HANDLE_READ_VERSION)  # pylint: disable=no-member
+        return self._read_metadata()[1]
+
+
+    def _read_metadata(self):
+        """Return the (name, firmware version) of the sensor, from cache if possible."""
+        with self.lock:
+            if not self._metadata_available():
+                self._read_session(())
+            return self._metadata
+
+
+    def _metadata_available(self):
+        """Check if there is fresh metadata in the cache."""
+        return self._metadata is not None and \
+            datetime.now() - self._metadata_timeout <= self._fw_last_read
 
-        if not firmwareRevision:
+
+    def read_session(self, parameters=MEASUREMENTS, metadata=None):
+        """Read the given parameters from the sensor over a single connection.
+
+        The name and firmware version are also read if metadata is True, or
+        if metadata is None and they are not in the cache yet.
+        Return a ParrotFlowerSnapshot, the measurements cache is not modified.
+        With a shared cache, the values fresh there are not read again and
+        the timestamp of the snapshot is the time of its oldest value.
+        """
+        with self.lock:
+            return self._read_session(parameters, metadata)
+
+
+    def _read_session(self, parameters, metadata=None):
+        """Read session without locking."""
+        if metadata is None:
+            metadata = not self._metadata_available()
+        if self._shared_cache is not None:
+            return self._read_shared(parameters, metadata)
+        metadata_read, values = self._read_sensor(parameters, metadata)
+        return self._snapshot(datetime.now(), metadata_read, values)
+
+
+    def _read_shared(self, parameters, metadata):
+        """Read session taking the values fresh in the shared cache, only the others are read."""
+        # other processes wait while this one reads the sensor, then find its values in the cache
+        with self._shared_cache.lock(self._mac, self.lock_timeout + self.session_timeout):
+            shared = self._shared_cache.get(self._mac)
+            now = time.time()
+            values = {}
+            oldest = now
+            for parameter in parameters:
+                if parameter in shared:
+                    value, read_time = shared[parameter]
+                    if now - read_time <= self._parameter_timeouts[parameter].total_seconds():
+                        values[parameter] = value
+                        oldest = min(oldest, read_time)
+            metadata_read = None
+            if metadata and 'metadata' in shared:
+                value, read_time = shared['metadata']
+                if now - read_time <= self._metadata_timeout.total_seconds():
+                    metadata_read = tuple(value)
+                    metadata = False
+            self._metrics.increment('parrot_flower_shared_cache_hits_total', len(values), mac=self._mac)
+
+            missing = [parameter for parameter in parameters if parameter not in values]
+            if missing or metadata:
+                read_metadata, read_values = self._read_sensor(missing, metadata)
+                self._shared_cache.put(self._mac, read_values, time.time(), read_metadata)
+                values.update(read_values)
+                metadata_read = read_metadata or metadata_read
+        return self._snapshot(datetime.fromtimestamp(oldest), metadata_read, values)
+
+
+    def _snapshot(self, timestamp, metadata_read, values):
+        """Store the metadata which was read and return the snapshot of a read session."""
+        if metadata_read is not None:
+            self._metadata = metadata_read
+            self._fw_last_read = datetime.now()
+        name, firmware = self._metadata if self._metadata is not None else (None, None)
+        return ParrotFlowerSnapshot(self._mac, timestamp, name, firmware, **values)
+
+
+    def _read_sensor(self, parameters, metadata):
+        """Read the sensor, with deadlines, return the metadata (or None) and the values read."""
+        session = _Session(partial(self._session, self._backend, parameters, metadata),
+                           'parrot-flower-' + self._mac)
+        session.start()
+        # the session fails by itself if the adapter is not free within lock_timeout
+        session.locked.wait()
+        start = session.locked_time or perf_counter()
+        try:
+            session.connected.wait(self.ble_timeout)
+            if not session.connected.is_set():
+                self._abandon(session)
+                raise BluetoothTimeout("Timeout connecting to %s after %ss" % (self._mac, self.ble_timeout))
+            session.join(max(0, self.session_timeout - (perf_counter() - start)))
+            if session.is_alive():
+                self._abandon(session)
+                raise BluetoothTimeout("Timeout reading from %s after %ss" % (self._mac, self.session_timeout))
+            if session.error is not None:
+                raise session.error
+            metadata_read, values = session.result
+        except Exception as error:
+            self._metrics.increment('parrot_flower_failures_total', mac=self._mac, adapter=self._adapter,
+                                    type=type(error).__name__)
+            raise
+        finally:
+            duration = perf_counter() - start
+            self.radio_time += duration
+            self._metrics.observe('parrot_flower_session_seconds', duration, mac=self._mac, adapter=self._adapter)
+        return metadata_read, values
+
+
+    def _session(self, backend, parameters, metadata, session):
+        """Connect and read, in the thread of the session.
+
+        Return the (name, firmware version) if metadata is True, None otherwise,
+        and the values of the parameters. Nothing is stored in the poller, an
+        abandoned session must not modify it.
+        """
+        with _AdapterConnection(backend, self._mac, adapter_lock(self._adapter), self.lock_timeout,
+                                session.lock_acquired) as connection:
+            session.connected.set()
+            self._metrics.observe('parrot_flower_connect_seconds', perf_counter() - session.locked_time,
+                                  mac=self._mac, adapter=self._adapter)
+            metadata_read = None
+            if metadata:
+                name = self._read_handle(connection, _HANDLE_READ_NAME, session)
+                firmware_revision = self._read_handle(connection, _HANDLE_READ_VERSION, session)
+                metadata_read = (decoder.decode_name(name), decoder.decode_firmware(firmware_revision))
+
+            values = {}
+            for parameter in parameters:
+                raw = self._read_handle(connection, _PARAMETER_HANDLES[parameter], session)
+                values[parameter] = _PARAMETER_DECODERS[parameter](raw)
+        return metadata_read, values
+
+
+    def _abandon(self, session):
+        """Cancel a hung session and replace its backend, which it may still use."""
+        _LOGGER.warning('Cancelling the connection to %s', self._mac)
+        session.cancelled.set()
+        backend = self._backend
+        try:
+            self._backend = self._new_backend()
+        finally:
+            _cancel(backend)
+
+
+    def _read_handle(self, connection, handle, session=None):
+        """Read a handle, raise if the sensor does not answer or if the session was cancelled."""
+        if session is not None and session.cancelled.is_set():
+            raise BluetoothTimeout("Session with %s cancelled" % self._mac)
+        start = perf_counter()
+        raw = connection.read_handle(handle)  # pylint: disable=no-member
+        self._metrics.observe('parrot_flower_read_seconds', perf_counter() - start,
+                              mac=self._mac, adapter=self._adapter)
+        if not raw:
             raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-        return firmwareRevision.decode("utf-8").split('_')[1].split('-')[1];
+        return raw
 
 
-    def fill_cache(self):
-        """Fill the cache with new data from the sensor."""
-        _LOGGER.debug('Filling cache with new sensor data.')
-        with self._bt_interface.connect(self._mac) as connection:
+    def due_parameters(self):
+        """Return the measurements which are not in the cache or whose cache is expired."""
+        now = datetime.now()
+        return [parameter for parameter in MEASUREMENTS
+                if parameter not in self._read_times or
+                now - self._parameter_timeouts[parameter] > self._read_times[parameter]]
 
-            # init cache
-            self._cache = {}
 
-            # battery
-            battery = connection.read_handle(_HANDLE_READ_BATTERY)  # pylint: disable=no-member
-            if not battery:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            self._cache[P_BATTERY] = ord(battery)
-
-            # air temperature
-            air_temperature = connection.read_handle(_HANDLE_READ_AIR_TEMPERATURE)  # pylint: disable=no-member
-            if not air_temperature:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            self._cache[P_AIR_TEMPERATURE] = round(unpack("<f",air_temperature)[0], 1)
-
-            # soil temperature
-            raw_soil_temperature = connection.read_handle(_HANDLE_READ_SOIL_TEMPERATURE)  # pylint: disable=no-member
-            if not raw_soil_temperature:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            soil_temperature = 0.00000003044 * pow(unpack("<H",raw_soil_temperature)[0], 3.0) - 0.00008038 * pow(unpack("<H",raw_soil_temperature)[0], 2.0) + unpack("<H",raw_soil_temperature)[0] * 0.1149 - 30.49999999999999
-            if soil_temperature < -10.0:
-                soil_temperature = -10.0
-            elif soil_temperature > 55.0:
-                soil_temperature = 55.0
-            self._cache[P_SOIL_TEMPERATURE] = round(soil_temperature, 1)
-            #self._cache[P_SOIL_TEMPERATURE] = round(unpack("<f",soil_temperature)[0], 1)
-
-            # moisture
-            moisture = connection.read_handle(_HANDLE_READ_MOISTURE)  # pylint: disable=no-member
-            if not moisture:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            self._cache[P_MOISTURE] = round(unpack("<f",moisture)[0])
-
-            # light
-            light = connection.read_handle(_HANDLE_READ_LIGHT)  # pylint: disable=no-member
-            if not light:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            #light_in_lux = round(unpack("<f",light)[0] * 54)
-            self._cache[P_LIGHT] = round(unpack("<f",light)[0], 2)
-
-            # conductivity
-            conductivity = connection.read_handle(_HANDLE_READ_CONDUCTIVITY)  # pylint: disable=no-member
-            if not conductivity:
-                raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
-            self._cache[P_CONDUCTIVITY] = unpack("<H",conductivity)[0]
-
-            _LOGGER.debug('Cache content: %s', "; ".join(["%s=%s" % (key, ('%('+key+')s') % self._cache) for key in self._cache]))
-            if self.cache_available():
-                self._last_read = datetime.now()
-            else:
-                # If a sensor doesn't work, wait 5 minutes before retrying
-                self._last_read = datetime.now() - self._cache_timeout + \
-                    timedelta(seconds=300)
+    def fill_cache(self, parameters=None):
+        """Fill the cache with new data from the sensor.
+
+        Only the measurements which are due are read, unless the list of
+        parameters to read is given.
+        """
+        if parameters is None:
+            parameters = self.due_parameters()
+        _LOGGER.debug('Filling cache with new sensor data: %s', ", ".join(parameters))
+        try:
+            snapshot = self._read_session(parameters)
+        except BluetoothBackendException:
+            # If a sensor doesn't work, wait 5 minutes before retrying
+            self._retry_after = datetime.now() + timedelta(seconds=300)
+            raise
+
+        self._retry_after = None
+        if self._cache is None:
+            self._cache = {}
+        self._cache.update(snapshot.measurements())
+        for parameter in parameters:
+            self._read_times[parameter] = snapshot.timestamp
+        _LOGGER.debug('Cache content: %s', "; ".join(["%s=%s" % (key, ('%('+key+')s') % self._cache) for key in self._cache]))
+        self._last_read = snapshot.timestamp
 
 
     def parameter_value(self, parameter, read_cached=True):
@@ -136,19 +478,23 @@ class ParrotFlowerPoller(object):
 
         This method will try to retrieve the data from cache and only
         request it by bluetooth if no cached value is stored or the cache is
-        expired.
+        expired. All the measurements which are due are then read at once.
         This behaviour can be overwritten by the "read_cached" parameter.
         """
         # Use the lock to make sure the cache isn't updated multiple times
         with self.lock:
-            if (read_cached is False) or \
-                    (self._last_read is None) or \
-                    (datetime.now() - self._cache_timeout > self._last_read):
+            if read_cached is False:
+                self.fill_cache(MEASUREMENTS)
+            elif parameter in self.due_parameters():
+                self._metrics.increment('parrot_flower_cache_misses_total', mac=self._mac)
+                if self._retry_after is not None and datetime.now() < self._retry_after:
+                    raise BluetoothBackendException("Could not read data from sensor %s" % self._mac)
                 self.fill_cache()
             else:
+                self._metrics.increment('parrot_flower_cache_hits_total', mac=self._mac)
                 _LOGGER.debug("Using cache (%s < %s)",
-                              datetime.now() - self._last_read,
-                              self._cache_timeout)
+                              datetime.now() - self._read_times[parameter],
+                              self._parameter_timeouts[parameter])
 
         if self.cache_available():
             return self._cache[parameter]
@@ -159,9 +505,222 @@ class ParrotFlowerPoller(object):
     def clear_cache(self):
         """Manually force the cache to be cleared."""
         self._cache = None
+        self._read_times = {}
+        self._retry_after = None
         self._last_read = None
+        self._metadata = None
+        self._fw_last_read = None
 
 
     def cache_available(self):
         """Check if there is data in the cache."""
-        return self._cache is not None
\ No newline at end of file
+        return self._cache is not None
+
+
+    def stream(self, parameters=LIVE_MEASUREMENTS, period=5, callback=None, buffer_size=1024):
+        """Return a started ParrotFlowerStream of the live measurements of the sensor."""
+        stream = ParrotFlowerStream(self, parameters, period, callback, buffer_size)
+        stream.start()
+        return stream
+
+
+def _bluepy_waiter(peripheral):
+    """Return a function waiting for the notifications of a bluepy peripheral, raising BluetoothBackendException."""
+    from bluepy.btle import BTLEException  # pylint: disable=import-error
+
+    def wait(timeout):
+        try:
+            return peripheral.waitForNotifications(timeout)
+        except BTLEException as error:
+            raise BluetoothBackendException(str(error)) from error
+    return wait
+
+
+class _LiveDelegate(object):
+    """
+    Pass the notifications of the sensor to a ParrotFlowerStream.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def handleNotification(self, handle, data):  # pylint: disable=invalid-name
+        """Called by the backend for each notification."""
+        self._stream._received(handle, data)  # pylint: disable=protected-access
+
+
+class ParrotFlowerStream(object):
+    """
+    Live measurements notified by a sensor over a connection kept open.
+
+    The sensor notifies the measurements every period seconds. The decoded
+    LiveReading are passed to the callback, from the thread of the stream,
+    and kept in a buffer read with readings(). When the buffer is full the
+    oldest readings are dropped. After a disconnection, or when the sensor
+    stays silent, the stream reconnects and subscribes again.
+
+    Streaming is not supported with the gatttool backend, which starts a new
+    gatttool process, with a new connection, to wait for each notification.
+    """
+
+    def __init__(self, poller, parameters=LIVE_MEASUREMENTS, period=5, callback=None, buffer_size=1024,
+                 resubscribe_delay=5, max_resubscribe_delay=300):
+        """
+        Stream the given measurements of the sensor read by poller.
+
+        The stream uses its own connection, the adapter lock of the poller is
+        only held while connecting and subscribing. A failed subscription is
+        retried after resubscribe_delay seconds, doubled after each failure
+        up to max_resubscribe_delay. Raise ValueError if the backend of the
+        poller is gatttool.
+        """
+        if poller._backend_class.__name__ == 'GatttoolBackend':  # pylint: disable=protected-access
+            raise ValueError("Streaming is not supported with the gatttool backend")
+        self._poller = poller
+        self._mac = poller.mac()
+        self._handles = dict((_PARAMETER_HANDLES[parameter], parameter) for parameter in parameters)
+        self._period = max(1, min(255, int(period)))
+        self._callback = callback
+        self._buffer = deque(maxlen=buffer_size)
+        self._condition = Condition()
+        self._resubscribe_delay = resubscribe_delay
+        self._max_resubscribe_delay = max_resubscribe_delay
+        # no notification for that long means a silently lost connection
+        self._silence_timeout = max(3 * self._period, poller.ble_timeout)
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name='parrot-flower-stream-' + self._mac)
+        self._thread.daemon = True
+        self.dropped = 0
+        self.error = None  # the error which stopped the stream
+
+
+    def start(self):
+        """Start streaming in a background thread."""
+        self._thread.start()
+
+
+    def stop(self, timeout=5.0):
+        """Stop streaming, the live mode of the sensor is switched off.
+
+        The stream stops at the latest when its current wait for a
+        notification ends, after one period.
+        """
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+
+    def readings(self, timeout=None):
+        """Yield the buffered readings as they arrive.
+
+        The iteration ends when the stream is stopped and the buffer is
+        empty, or when no reading arrived for timeout seconds.
+        """
+        while True:
+            with self._condition:
+                if not self._buffer and not self._stopped.is_set():
+                    self._condition.wait(timeout)
+                if not self._buffer:
+                    return
+                reading = self._buffer.popleft()
+            yield reading
+
+
+    def __iter__(self):
+        return self.readings()
+
+
+    def _run(self):
+        """Subscribe and listen until stopped, subscribing again after each interruption.
+
+        Any other error than a bluetooth one is fatal: it stops the stream,
+        the readers are woken and the error is kept in the error attribute.
+        """
+        delay = self._resubscribe_delay
+        try:
+            while not self._stopped.is_set():
+                backend = self._poller._new_backend()  # pylint: disable=protected-access
+                try:
+                    self._subscribe(backend)
+                    delay = self._resubscribe_delay
+                    self._listen(backend)
+                except BluetoothBackendException as error:
+                    _LOGGER.warning('Live measurements of %s interrupted: %s', self._mac, error)
+                    self._poller._metrics.increment('parrot_flower_stream_interruptions_total',  # pylint: disable=protected-access
+                                                    mac=self._mac)
+                finally:
+                    self._unsubscribe(backend)
+                if self._stopped.wait(delay):
+                    break
+                delay = min(2 * delay, self._max_resubscribe_delay)
+        except Exception as error:  # pylint: disable=broad-except
+            _LOGGER.exception('Live measurements of %s stopped', self._mac)
+            self.error = error
+            self._stopped.set()
+            with self._condition:
+                self._condition.notify_all()
+
+
+    def _subscribe(self, backend):
+        """Connect, start the live mode and enable the notifications."""
+        with adapter_lock(self._poller.adapter()):
+            backend.connect(self._mac)
+            backend.write_handle(_HANDLE_LIVE_MEASURE_PERIOD, bytes([self._period]))
+            for handle in self._handles:
+                backend.write_handle(handle + 1, _ENABLE_NOTIFICATIONS)
+        _LOGGER.debug('Streaming live measurements of %s every %ss', self._mac, self._period)
+
+
+    def _listen(self, backend):
+        """Wait for notifications until stopped, raise if the sensor stays silent.
+
+        The notifications were enabled once by _subscribe. With bluepy the
+        peripheral waits for them directly, as wait_for_notification writes
+        the notification descriptor again on each call.
+        """
+        delegate = _LiveDelegate(self)
+        peripheral = getattr(backend, '_peripheral', None)
+        if peripheral is not None:
+            peripheral.withDelegate(delegate)
+            wait = _bluepy_waiter(peripheral)
+        else:
+            handle = min(self._handles) + 1
+            wait = partial(backend.wait_for_notification, handle, delegate)
+        last = time.time()
+        while not self._stopped.is_set():
+            if wait(self._period):
+                last = time.time()
+            elif time.time() - last > self._silence_timeout:
+                raise BluetoothBackendException("No live measurement from %s for %ss" %
+                                                (self._mac, self._silence_timeout))
+
+
+    def _unsubscribe(self, backend):
+        """Stop the live mode, to save the battery of the sensor, and disconnect."""
+        try:
+            backend.write_handle(_HANDLE_LIVE_MEASURE_PERIOD, bytes([0]))
+        except Exception:  # pylint: disable=broad-except
+            pass
+        try:
+            backend.disconnect()
+        except Exception:  # pylint: disable=broad-except
+            pass
+
+
+    def _received(self, handle, data):
+        """Decode a notification, buffer it and pass it to the callback."""
+        parameter = self._handles.get(handle)
+        if parameter is None or not data:
+            return
+        reading = LiveReading(self._mac, datetime.now(), parameter, _PARAMETER_DECODERS[parameter](data))
+        with self._condition:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(reading)
+            self._condition.notify()
+        if self._callback is not None:
+            try:
+                self._callback(reading)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception('Live measurement callback failed')
\ No newline at end of file
@@ -0,0 +1,163 @@
+"""
+Persistent registry of the known Parrot Flower Power & Pot sensors.
+
+Each sensor gets a block index which never changes once allocated, so the
+Domoticz units of a sensor stay the same whatever the order of the macs.
+The registry is a journal of JSON lines: every change appends the new
+record of a sensor, the file is compacted (rewritten atomically) when the
+journal gets much longer than the number of sensors.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import os
+from threading import Lock
+
+_LOGGER = logging.getLogger(__name__)
+
+SensorRecord = namedtuple('SensorRecord', ('mac', 'block', 'name', 'firmware', 'adapter', 'last_seen', 'rssi'))
+# the fields added later are missing from the older journals
+SensorRecord.__new__.__defaults__ = (None,)
+
+
+class SensorRegistry(object):
+    """
+    MAC address -> SensorRecord, persisted in a file.
+    """
+
+    def __init__(self, filename, max_blocks=None):
+        """
+        Load the registry from filename, it is created on the first change.
+
+        At most max_blocks block indexes are allocated (no limit if None).
+        """
+        self._filename = filename
+        self._max_blocks = max_blocks
+        self._records = {}
+        self._blocks = {}
+        self._journal_length = 0
+        self._lock = Lock()
+        self._load()
+
+
+    def _load(self):
+        """Replay the journal."""
+        try:
+            with open(self._filename) as journal:
+                for line in journal:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line truncated by a crash during a write
+                        _LOGGER.warning('Ignoring invalid line in %s', self._filename)
+                        continue
+                    self._journal_length += 1
+                    if entry.get('deleted'):
+                        self._forget(entry['mac'])
+                    else:
+                        self._store(SensorRecord(**entry))
+        except FileNotFoundError:
+            pass
+
+
+    def _store(self, record):
+        """Store a record in memory."""
+        self._forget(record.mac)
+        self._records[record.mac] = record
+        self._blocks[record.block] = record.mac
+
+
+    def _forget(self, mac):
+        """Remove a record from memory."""
+        record = self._records.pop(mac, None)
+        if record is not None:
+            del self._blocks[record.block]
+
+
+    def __contains__(self, mac):
+        return mac.upper() in self._records
+
+
+    def __len__(self):
+        return len(self._records)
+
+
+    def get(self, mac):
+        """Return the record of a sensor, or None."""
+        return self._records.get(mac.upper())
+
+
+    def macs(self):
+        """Return the macs of the sensors, in block order."""
+        return [self._blocks[block] for block in sorted(self._blocks)]
+
+
+    def add(self, mac, **fields):
+        """Register a sensor, allocating the lowest free block.
+
+        Return the record of the sensor (the existing one if it was already
+        registered), or None if all the blocks are allocated.
+        """
+        mac = mac.upper()
+        with self._lock:
+            if mac in self._records:
+                return self._records[mac]
+            block = 0
+            while block in self._blocks:
+                block += 1
+            if self._max_blocks is not None and block >= self._max_blocks:
+                return None
+            record = SensorRecord(mac, block, fields.get('name'), fields.get('firmware'),
+                                  fields.get('adapter'), fields.get('last_seen'), fields.get('rssi'))
+            self._store(record)
+            self._append(record._asdict())
+            return record
+
+
+    def update(self, mac, **fields):
+        """Change some fields of the record of a registered sensor.
+
+        Nothing is written if the fields did not change.
+        """
+        mac = mac.upper()
+        with self._lock:
+            record = self._records[mac]
+            updated = record._replace(**fields)
+            if updated != record:
+                self._store(updated)
+                self._append(updated._asdict())
+            return updated
+
+
+    def remove(self, mac):
+        """Unregister a sensor, its block can be allocated again."""
+        mac = mac.upper()
+        with self._lock:
+            if mac in self._records:
+                self._forget(mac)
+                self._append({'mac': mac, 'deleted': True})
+
+
+    def _append(self, entry):
+        """Append an entry to the journal, compacting it when needed."""
+        if self._journal_length > 2 * len(self._records) + 16:
+            self._compact()
+            return
+        with open(self._filename, 'a') as journal:
+            journal.write(json.dumps(entry) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        self._journal_length += 1
+
+
+    def _compact(self):
+        """Rewrite the journal with one line per sensor, atomically."""
+        temporary = self._filename + '.tmp'
+        with open(temporary, 'w') as journal:
+            for mac in self.macs():
+                journal.write(json.dumps(self._records[mac]._asdict()) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary, self._filename)
+        self._journal_length = len(self._records)
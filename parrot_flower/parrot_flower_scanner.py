@@ -1,20 +1,101 @@
 """Scan for Parrot Flower Power & Pot devices"""
 
+import time
+
 # use only lower case names here
 VALID_DEVICE_NAMES = ['flower power',
                       'parrot pot']
 
 DEVICE_PREFIX = 'A0:14:3D:'
 
+# advertising data types of the device names
+_COMPLETE_LOCAL_NAME = 9
+_SHORT_LOCAL_NAME = 8
+
+# seconds between two checks for new advertisements
+_SCAN_SLICE = 0.5
+
+
+def _is_parrot(mac, name):
+    """Check if an advertisement comes from a Parrot Flower Power & Pot."""
+    return (name is not None and name.lower() in VALID_DEVICE_NAMES) or \
+        mac is not None and mac.upper().startswith(DEVICE_PREFIX)
+
+
+def _bluepy_devices(timeout, adapter):
+    """Yield (mac, name, rssi) for the advertisements received by bluepy, as they arrive."""
+    from bluepy.btle import Scanner, DefaultDelegate
+
+    class _Delegate(DefaultDelegate):
+        def __init__(self):
+            DefaultDelegate.__init__(self)
+            self.devices = []
+
+        def handleDiscovery(self, scanEntry, isNewDev, isNewData):
+            self.devices.append((scanEntry.addr, scanEntry.getValueText(_COMPLETE_LOCAL_NAME) or
+                                 scanEntry.getValueText(_SHORT_LOCAL_NAME), scanEntry.rssi))
+
+    delegate = _Delegate()
+    scanner = Scanner(int(adapter.replace('hci', ''))).withDelegate(delegate)
+    deadline = time.time() + timeout
+    scanner.clear()
+    scanner.start()
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            scanner.process(min(_SCAN_SLICE, remaining))
+            devices, delegate.devices = delegate.devices, []
+            for device in devices:
+                yield device
+    finally:
+        scanner.stop()
+
+
+def _backend_devices(backend, timeout, adapter):
+    """Yield (mac, name, rssi) for the devices found by a backend."""
+    iter_devices = getattr(backend, 'iter_devices', None)
+    if iter_devices is not None:
+        return iter_devices(timeout, adapter)
+    if backend.__name__ == 'BluepyBackend':
+        return _bluepy_devices(timeout, adapter)
+    # the other backends only return their results at the end of the scan, without RSSI
+    return ((mac, name, None) for mac, name in backend.scan_for_devices(timeout, adapter))
+
+
+def scan_iter(backend, timeout=10, expected=None, count=None, adapter='hci0'):
+    """Yield (mac, name, rssi) for each Parrot Flower Power & Pot found.
+
+    The devices are yielded once each, as soon as their advertisements are
+    received when the backend allows it (bluepy). The scan stops after
+    timeout seconds, or earlier when all the expected macs were found or
+    when count devices were found. rssi is None if the backend does not
+    report it.
+
+    Note: this must be run as root!
+    """
+    expected = set(mac.upper() for mac in expected) if expected else None
+    found = set()
+    devices = _backend_devices(backend, timeout, adapter)
+    try:
+        for mac, name, rssi in devices:
+            if not _is_parrot(mac, name) or mac.upper() in found:
+                continue
+            mac = mac.upper()
+            found.add(mac)
+            yield mac, name, rssi
+            if (expected is not None and expected <= found) or (count is not None and len(found) >= count):
+                break
+    finally:
+        close = getattr(devices, 'close', None)
+        if close is not None:
+            close()
+
 
 def scan(backend, timeout=10):
     """Scan for Parrot Flower Power & Pot devices.
 
     Note: this must be run as root!
     """
-    result = []
-    for (mac, name) in backend.scan_for_devices(timeout):
-        if (name is not None and name.lower() in VALID_DEVICE_NAMES) or \
-                mac is not None and mac.upper().startswith(DEVICE_PREFIX):
-            result.append(mac.upper())
-    return result
+    return [mac for mac, _, _ in scan_iter(backend, timeout)]
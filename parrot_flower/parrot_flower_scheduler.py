@@ -0,0 +1,122 @@
+"""
+Schedule the polls of Parrot Flower Power & Pot sensors.
+
+Every sensor has its own due time, kept in a priority queue. The intervals
+are jittered so that the sensors do not all fire together, a sensor which
+failed once gets an early retry and a sensor which keeps failing is polled
+less and less often, up to a maximum interval.
+"""
+
+import heapq
+import random
+import time
+
+
+class PollScheduler(object):
+    """
+    Priority queue of the due times of the sensors.
+
+    A sensor returned by due() is in flight: it is not scheduled again until
+    success() or failure() is called for it.
+    """
+
+    def __init__(self, interval, jitter=0.1, retry_delay=300, max_interval=None, clock=time.time):
+        """
+        Poll every interval seconds, +/- jitter * interval.
+
+        After a single failure the sensor is retried after retry_delay seconds,
+        after more failures the interval doubles each time, up to max_interval
+        (4 times interval if None).
+        """
+        self._interval = interval
+        self._jitter = jitter
+        self._retry_delay = retry_delay
+        self._max_interval = max_interval if max_interval is not None else 4 * interval
+        self._clock = clock
+        self._queue = []
+        self._due = {}  # mac -> due time of the entry in the queue
+        self._failures = {}
+        self._in_flight = set()
+
+
+    def __contains__(self, mac):
+        return mac in self._due or mac in self._in_flight
+
+
+    def add(self, mac, delay=None):
+        """Schedule a new sensor, its first poll is after delay seconds or spread over the jitter window if None."""
+        if mac not in self:
+            self._failures[mac] = 0
+            self._schedule(mac, random.uniform(0, self._jitter * self._interval) if delay is None else delay)
+
+
+    def remove(self, mac):
+        """Stop scheduling a sensor."""
+        self._due.pop(mac, None)
+        self._failures.pop(mac, None)
+        self._in_flight.discard(mac)
+
+
+    def due(self):
+        """Return the sensors to poll now, they are marked in flight."""
+        now = self._clock()
+        macs = []
+        while self._queue and self._queue[0][0] <= now:
+            due, mac = heapq.heappop(self._queue)
+            # skip the entries of removed or rescheduled sensors
+            if self._due.get(mac) == due:
+                del self._due[mac]
+                self._in_flight.add(mac)
+                macs.append(mac)
+        return macs
+
+
+    def next_due(self):
+        """Return the time of the next poll, or None."""
+        return min(self._due.values()) if self._due else None
+
+
+    def failures(self, mac):
+        """Return the number of consecutive failures of a sensor."""
+        return self._failures.get(mac, 0)
+
+
+    def success(self, mac, interval=None):
+        """Record a successful poll and schedule the next one, after interval seconds if given."""
+        if mac in self._in_flight:
+            self._in_flight.discard(mac)
+            self._failures[mac] = 0
+            self._schedule(mac, self._jittered(self._interval if interval is None else interval))
+
+
+    def failure(self, mac):
+        """Record a failed poll and schedule a retry."""
+        if mac in self._in_flight:
+            self._in_flight.discard(mac)
+            failures = self._failures.get(mac, 0) + 1
+            self._failures[mac] = failures
+            if failures == 1:
+                # probably a transient error, retry soon
+                delay = self._retry_delay * random.uniform(1, 1 + self._jitter)
+            else:
+                delay = self._jittered(min(self._interval * 2 ** (failures - 2), self._max_interval))
+            self._schedule(mac, delay)
+
+
+    def postpone(self, mac, delay):
+        """Put back an in flight sensor which could not be polled, without counting a failure."""
+        if mac in self._in_flight:
+            self._in_flight.discard(mac)
+            self._schedule(mac, delay)
+
+
+    def _jittered(self, delay):
+        """Return delay +/- jitter."""
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+
+    def _schedule(self, mac, delay):
+        """Schedule a poll of a sensor in delay seconds."""
+        due = self._clock() + delay
+        self._due[mac] = due
+        heapq.heappush(self._queue, (due, mac))
@@ -0,0 +1,132 @@
+"""
+Cache of the sensor readings shared by several processes.
+
+The Domoticz plugin, demo.py and other scripts reading the same sensors
+can share their readings instead of each connecting to the sensors. Each
+sensor has a small JSON file, replaced atomically, and a lock file: the
+process holding the lock of a sensor is the only one reading it, the
+others wait and then find its fresh readings in the cache.
+"""
+
+import json
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_LOGGER = logging.getLogger(__name__)
+
+# seconds between two attempts to take a lock held by another process
+_LOCK_POLL = 0.05
+
+
+class _FileLock(object):
+    """
+    Context manager holding an exclusive lock on a file, shared by all the processes.
+
+    If the lock is not acquired within timeout seconds (None waits forever),
+    the block runs without it.
+    """
+
+    def __init__(self, filename, timeout=None):
+        self._filename = filename
+        self._timeout = timeout
+        self._file = None
+
+    def __enter__(self):
+        if fcntl is None:
+            return self
+        self._file = open(self._filename, 'a')
+        deadline = None if self._timeout is None else time.time() + self._timeout
+        while True:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except OSError:
+                if deadline is not None and time.time() >= deadline:
+                    _LOGGER.warning('Could not lock %s, going on without the lock', self._filename)
+                    self._file.close()
+                    self._file = None
+                    return self
+                time.sleep(_LOCK_POLL)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class SharedCache(object):
+    """
+    Readings of the sensors, by MAC address, stored in a directory.
+
+    A reading is dropped once it is older than the TTL of its sensor, the
+    readers also ignore the readings older than their own cache timeouts.
+    """
+
+    def __init__(self, directory, ttl=3600, ttls=None):
+        """
+        Store the readings in directory, created if needed.
+
+        ttl is the time to live in seconds of the readings, ttls maps MAC
+        addresses to their own time to live.
+        """
+        self._directory = directory
+        self._ttl = ttl
+        self._ttls = dict((mac.upper(), value) for mac, value in (ttls or {}).items())
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def ttl(self, mac):
+        """Return the time to live of the readings of a sensor."""
+        return self._ttls.get(mac.upper(), self._ttl)
+
+
+    def _filename(self, mac, extension):
+        return os.path.join(self._directory, mac.upper().replace(':', '') + extension)
+
+
+    def lock(self, mac, timeout=None):
+        """Return a context manager holding the lock of a sensor for all the processes."""
+        return _FileLock(self._filename(mac, '.lock'), timeout)
+
+
+    def get(self, mac):
+        """Return the live readings of a sensor.
+
+        The result maps the measurements to (value, time read) and
+        'metadata' to ((name, firmware version), time read), time read
+        being in seconds since the epoch.
+        """
+        try:
+            with open(self._filename(mac, '.json')) as cache:
+                content = json.load(cache)
+        except (OSError, ValueError):
+            return {}
+        oldest = time.time() - self.ttl(mac)
+        return dict((key, (value, read_time)) for key, (value, read_time) in content.items()
+                    if read_time >= oldest)
+
+
+    def put(self, mac, values, read_time, metadata=None):
+        """Store the measurements (a dict) and metadata (name, firmware version) read at read_time.
+
+        The other readings of the sensor are kept, the file is replaced
+        atomically so the readers never see it half written.
+        """
+        content = self.get(mac)
+        for key, value in values.items():
+            content[key] = (value, read_time)
+        if metadata is not None:
+            content['metadata'] = (list(metadata), read_time)
+        filename = self._filename(mac, '.json')
+        temporary = '%s.%d.tmp' % (filename, os.getpid())
+        with open(temporary, 'w') as cache:
+            json.dump(content, cache)
+        os.replace(temporary, filename)
@@ -0,0 +1,188 @@
+"""
+Local time series of the readings of Parrot Flower Power & Pot sensors.
+
+Each sensor has its own file: a header followed by a ring of fixed-width
+binary records, memory mapped. When the ring is full the oldest reading
+is overwritten, so a file never grows past its capacity. Readings are
+appended in time order, a time range is found by bisection.
+"""
+
+from collections import namedtuple
+import math
+import mmap
+import os
+from struct import Struct
+from threading import Lock
+
+from parrot_flower.parrot_flower_poller import P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, \
+    P_MOISTURE, P_LIGHT, P_CONDUCTIVITY, P_BATTERY
+
+_MAGIC = b"PFTS0001"
+# magic, capacity, next slot, count
+_HEADER = Struct("<8sIII")
+_HEADER_SIZE = 32
+# timestamp, air temperature, soil temperature, moisture, light, conductivity, battery
+_RECORD = Struct("<dffffHBx")
+
+# missing values
+_NO_CONDUCTIVITY = 0xFFFF
+_NO_BATTERY = 0xFF
+
+Reading = namedtuple('Reading', ('timestamp', P_AIR_TEMPERATURE, P_SOIL_TEMPERATURE, P_MOISTURE,
+                                 P_LIGHT, P_CONDUCTIVITY, P_BATTERY))
+
+
+def _float(value):
+    return float('nan') if value is None else value
+
+
+def _optional(value):
+    return None if math.isnan(value) else round(value, 2)
+
+
+class TimeSeries(object):
+    """
+    Ring buffer of the readings of one sensor, in a memory mapped file.
+    """
+
+    def __init__(self, filename, capacity=2880):
+        """
+        Open or create the file of a time series.
+
+        capacity (the number of readings kept) is only used when the file
+        is created, an existing file keeps its capacity.
+        """
+        self._lock = Lock()
+        exists = os.path.exists(filename) and os.path.getsize(filename) >= _HEADER_SIZE
+        self._file = open(filename, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, capacity, _, _ = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != _MAGIC:
+                self._file.close()
+                raise ValueError("%s is not a time series file" % filename)
+        else:
+            self._file.truncate(_HEADER_SIZE + capacity * _RECORD.size)
+        self._capacity = capacity
+        self._map = mmap.mmap(self._file.fileno(), _HEADER_SIZE + capacity * _RECORD.size)
+        if not exists:
+            _HEADER.pack_into(self._map, 0, _MAGIC, capacity, 0, 0)
+
+
+    def close(self):
+        """Flush and close the file."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._file.close()
+                self._map = None
+
+
+    def __len__(self):
+        return _HEADER.unpack_from(self._map, 0)[3]
+
+
+    def append(self, timestamp, values):
+        """Append a reading, values maps the P_* parameters to their value.
+
+        timestamp is in seconds since the epoch and must not be older than
+        the last reading.
+        """
+        record = _RECORD.pack(timestamp,
+                              _float(values.get(P_AIR_TEMPERATURE)),
+                              _float(values.get(P_SOIL_TEMPERATURE)),
+                              _float(values.get(P_MOISTURE)),
+                              _float(values.get(P_LIGHT)),
+                              values.get(P_CONDUCTIVITY, _NO_CONDUCTIVITY),
+                              values.get(P_BATTERY, _NO_BATTERY))
+        with self._lock:
+            _, _, slot, count = _HEADER.unpack_from(self._map, 0)
+            offset = _HEADER_SIZE + slot * _RECORD.size
+            self._map[offset:offset + _RECORD.size] = record
+            _HEADER.pack_into(self._map, 0, _MAGIC, self._capacity, (slot + 1) % self._capacity,
+                              min(count + 1, self._capacity))
+
+
+    def _reading(self, slot):
+        """Decode the reading stored in a slot."""
+        (timestamp, air_temperature, soil_temperature, moisture, light, conductivity,
+         battery) = _RECORD.unpack_from(self._map, _HEADER_SIZE + slot * _RECORD.size)
+        return Reading(timestamp, _optional(air_temperature), _optional(soil_temperature),
+                       _optional(moisture), _optional(light),
+                       None if conductivity == _NO_CONDUCTIVITY else conductivity,
+                       None if battery == _NO_BATTERY else battery)
+
+
+    def _bisect(self, first, count, timestamp):
+        """Return the position of the first reading not older than timestamp, 0 being the oldest."""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            slot = (first + middle) % self._capacity
+            if _RECORD.unpack_from(self._map, _HEADER_SIZE + slot * _RECORD.size)[0] < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+    def query(self, start=None, end=None):
+        """Return the readings with start <= timestamp < end, oldest first."""
+        with self._lock:
+            _, _, slot, count = _HEADER.unpack_from(self._map, 0)
+            first = (slot - count) % self._capacity
+            low = 0 if start is None else self._bisect(first, count, start)
+            high = count if end is None else self._bisect(first, count, end)
+            return [self._reading((first + position) % self._capacity) for position in range(low, high)]
+
+
+    def latest(self, number=1):
+        """Return the last readings, oldest first."""
+        with self._lock:
+            _, _, slot, count = _HEADER.unpack_from(self._map, 0)
+            number = min(number, count)
+            return [self._reading((slot - number + position) % self._capacity) for position in range(number)]
+
+
+class TimeSeriesStore(object):
+    """
+    The time series of several sensors, one file per sensor in a directory.
+    """
+
+    def __init__(self, directory, capacity=2880):
+        self._directory = directory
+        self._capacity = capacity
+        self._series = {}
+        self._lock = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+
+    def series(self, mac):
+        """Return the TimeSeries of a sensor, it is opened on first use."""
+        mac = mac.upper()
+        with self._lock:
+            series = self._series.get(mac)
+            if series is None:
+                filename = os.path.join(self._directory, mac.replace(':', '') + '.pfts')
+                series = TimeSeries(filename, self._capacity)
+                self._series[mac] = series
+            return series
+
+
+    def append(self, mac, timestamp, values):
+        """Append a reading to the time series of a sensor."""
+        self.series(mac).append(timestamp, values)
+
+
+    def query(self, mac, start=None, end=None):
+        """Return the readings of a sensor with start <= timestamp < end."""
+        return self.series(mac).query(start, end)
+
+
+    def close(self):
+        """Close all the files."""
+        with self._lock:
+            for series in self._series.values():
+                series.close()
+            self._series = {}
@@ -0,0 +1,120 @@
+"""
+Run Parrot Flower Power & Pot polls on background worker threads.
+"""
+
+import logging
+from queue import Queue, Empty, Full
+from threading import Thread
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PollerPool(object):
+    """
+    A pool of worker threads executing poll jobs taken from bounded queues.
+
+    Jobs are submitted without blocking and their outcome is collected later
+    with results(), so the caller never waits for a Bluetooth connection.
+    Each lane (usually a Bluetooth adapter) has its own queue and workers,
+    the lanes run at the same time.
+    """
+
+    def __init__(self, lanes=('hci0',), workers=1, queue_size=64):
+        """
+        Start the given number of worker threads for each lane.
+        """
+
+        self._jobs = {}
+        self._results = Queue()
+        self._threads = []
+        for lane in lanes:
+            jobs = Queue(maxsize=queue_size)
+            self._jobs[lane] = jobs
+            for num in range(workers):
+                thread = Thread(target=self._run, args=(jobs,),
+                                name="ParrotFlowerWorker-{}-{}".format(lane, num))
+                thread.daemon = True
+                thread.start()
+                self._threads.append((jobs, thread))
+
+
+    def lanes(self):
+        """Return the names of the lanes."""
+        return list(self._jobs)
+
+
+    def submit(self, lane, key, func, *args):
+        """Queue func(*args) for execution in the given lane.
+
+        Return False without blocking if the job queue of the lane is full.
+        """
+        try:
+            self._jobs[lane].put_nowait((key, func, args))
+        except Full:
+            _LOGGER.debug('Job queue of %s full, dropping job %s', lane, key)
+            return False
+        return True
+
+
+    def results(self, timeout=0):
+        """Return the (key, value, error) tuples of all the finished jobs.
+
+        If none is finished, wait at most timeout seconds (None waits
+        forever) for the next one.
+        """
+        finished = []
+        if timeout != 0:
+            try:
+                finished.append(self._results.get(timeout=timeout))
+            except Empty:
+                return finished
+        while True:
+            try:
+                finished.append(self._results.get_nowait())
+            except Empty:
+                return finished
+
+
+    def pending(self, lane=None):
+        """Return the number of jobs waiting for a worker, in one or all the lanes."""
+        if lane is not None:
+            return self._jobs[lane].qsize()
+        return sum(jobs.qsize() for jobs in self._jobs.values())
+
+
+    def stop(self, timeout=1.0):
+        """Drop the waiting jobs and stop the worker threads.
+
+        Workers busy with a job are given at most timeout seconds to finish,
+        they are daemon threads and will not keep the process alive.
+        """
+        for jobs in self._jobs.values():
+            while True:
+                try:
+                    jobs.get_nowait()
+                except Empty:
+                    break
+        for jobs, _ in self._threads:
+            try:
+                jobs.put_nowait(None)
+            except Full:
+                pass
+        for _, thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+
+    def _run(self, jobs):
+        """Worker loop: execute jobs until a None sentinel is received."""
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            key, func, args = job
+            try:
+                value = func(*args)
+            except Exception as error:  # pylint: disable=broad-except
+                _LOGGER.debug('Job %s failed: %s', key, error)
+                self._results.put((key, None, error))
+            else:
+                self._results.put((key, value, None))
@@ -19,6 +19,8 @@
             </options>
         </param>
         <param field="Mode4" label="Polling interval (minutes, 30 mini)" width="40px" required="true" default="60"/>
+        <param field="Mode5" label="Bluetooth adapters, comma separated" width="300px" required="false" default="hci0"/>
+        <param field="Mode6" label="Options (key=value, comma separated)" width="300px" required="false" default=""/>
     </params>
 </plugin>
 """
@@ -30,60 +32,189 @@ try:
 except ImportError:
     import fakeDomoticz as Domoticz
 import time
-import sys
-sys.path.append("/usr/local/lib/python3.5/dist-packages")
+import importlib
 import shelve
 import os
-from datetime import datetime
-from datetime import timedelta
 from parrot_flower import parrot_flower_scanner
+from parrot_flower.parrot_flower_worker import PollerPool
+from parrot_flower.parrot_flower_registry import SensorRegistry
+from parrot_flower.parrot_flower_timeseries import TimeSeriesStore
+from parrot_flower.parrot_flower_aggregates import AggregateStore
+from parrot_flower.parrot_flower_scheduler import PollScheduler
+from parrot_flower.parrot_flower_deadband import Deadband
+from parrot_flower.parrot_flower_policy import BatteryPolicy
+from parrot_flower.parrot_flower_metrics import METRICS
+from parrot_flower.parrot_flower_shared_cache import SharedCache
+from parrot_flower.parrot_flower_cluster import Coordinator, LeaseTable
 import parrot_flower
 try:
-    from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, \
+    from parrot_flower.parrot_flower_poller import ParrotFlowerPoller, MEASUREMENTS, adapter_lock, \
         P_CONDUCTIVITY, P_MOISTURE, P_LIGHT, P_AIR_TEMPERATURE, P_BATTERY, P_SOIL_TEMPERATURE
 except:
     bluepyError = 1
-try:
-    from btlewrap import GatttoolBackend, BluepyBackend, PygattBackend
-except:
-    bluepyError = 1
+
+# backend module and class of each backend selection, only the selected one is imported
+BACKENDS = {
+    "gatttool": ("btlewrap.gatttool", "GatttoolBackend"),
+    "bluepy": ("btlewrap.bluepy", "BluepyBackend"),
+    "pygatt": ("btlewrap.pygatt", "PygattBackend"),
+}
+
+POLL_WORKERS = 1  # number of threads doing the bluetooth reads, per adapter
+POLL_QUEUE_SIZE = 64  # maximum number of polls waiting for a worker
+
+UNITS_PER_SENSOR = 5  # moisture, air temperature, light, conductivity, soil temperature
+MAX_SENSORS = 255 // UNITS_PER_SENSOR  # Domoticz allows 255 units per hardware
+
+# units of the optional devices showing the plugin metrics, after the sensors
+METRICS_DEVICES = (
+    (251, "Poll session time", "ms"),
+    (252, "Poll failures", "count"),
+    (253, "Heartbeat time", "ms"),
+)
+METRICS_INTERVAL = 5  # minutes between two metrics snapshots
+
+# optional devices showing the rolling statistics of each sensor: statistic, name, type, custom unit
+AGGREGATE_DEVICES = (
+    ("dli", "Daily Light Integral", "Custom", "mol/m2"),
+    ("moisture_min", "Moisture Min", "Percentage", None),
+    ("moisture_max", "Moisture Max", "Percentage", None),
+    ("air_temperature_mean", "Air Temperature Mean", "Temperature", None),
+)
+# the sensors get fewer units with the statistics devices, which follow the units of the sensors
+AGGREGATE_MAX_SENSORS = (METRICS_DEVICES[0][0] - 1) // (UNITS_PER_SENSOR + len(AGGREGATE_DEVICES))
+AGGREGATE_UNIT = AGGREGATE_MAX_SENSORS * UNITS_PER_SENSOR + 1
+AGGREGATE_HOURS = 24  # default window of the min/max/mean statistics
+
+POLL_JITTER = 0.1  # the polling interval of each sensor varies by +/- 10%
+RETRY_DELAY = 5  # minutes before retrying a sensor which failed once
+BATTERY_LOW = 30  # %, sensors with less battery are polled less often
+HISTORY_DAYS = 30  # default number of days of readings kept locally
+SCAN_TIMEOUT = 10  # seconds, the scan stops earlier once all the known sensors were seen
+DISCOVERY_INTERVAL = 15  # minutes between two background scans for new sensors, in automatic mode
+DISCOVERY_TIMEOUT = 5  # seconds, duration of a background scan
+DISCOVERY_KEY = "discovery"  # key of the background scan jobs in the poller pool
+LOCAL_NODE = "domoticz"  # name of the plugin among the collector nodes
+BLE_TIMEOUT = 10  # seconds to connect to a sensor
+SESSION_TIMEOUT = 30  # seconds to connect to a sensor and read it
+
+# default changes below which a device is not updated, can be changed with a deadband_<name> option
+DEADBANDS = {
+    "moisture": 1,  # %
+    "air_temperature": 0.2,  # degrees Celsius
+    "soil_temperature": 0.2,  # degrees Celsius
+    "light": 54,  # lux
+    "conductivity": 10,
+    "dli": 0.1,  # mol/m2
+}
+REFRESH_MAX = 120  # minutes, devices are updated at least this often
+
+# default refresh intervals in minutes of the slowly changing measurements,
+# the others are read on every poll. Can be changed with a <name>_interval option.
+PARAMETER_INTERVALS = {
+    "battery": 12 * 60,
+    "conductivity": 2 * 60,
+    "soil_temperature": 2 * 60,
+}
 
 class BasePlugin:
 
     def __init__(self):
         self.macs = []
-        self.backend = GatttoolBackend
-        self.currentlyPolling = 255
-        self.nextupdate = datetime.now()
+        self.backend = None
         self.pollinterval = 60  # default polling interval in minutes
+        self.pool = None
+        self.scheduler = None  # due time of the next poll of each sensor
+        self.pollMin = 60  # shortest polling interval in minutes
+        self.policy = None  # stretches the polling interval of the sensors with a weak battery or costly polls
+        # long-lived pollers by mac, they keep their cache between polls. The sensors are only
+        # added while running, Domoticz restarts the plugin when its configuration changes
+        self.pollers = {}
+        self.options = {}
+        self.parameterIntervals = dict(PARAMETER_INTERVALS)
+        self.adapters = ["hci0"]
+        self.sensorAdapters = {}  # adapter used by each mac
+        self.registry = None  # known sensors and their unit blocks
+        self.timeseries = None  # local history of the readings
+        self.deadband = None  # skips the device updates which would not change anything
+        self.aggregates = None  # rolling statistics of the readings
+        self.aggregateDevices = False
+        self.metricsDevices = False
+        self.metricsInterval = METRICS_INTERVAL
+        self.nextMetrics = 0
+        self.bleTimeout = BLE_TIMEOUT
+        self.sessionTimeout = SESSION_TIMEOUT
+        self.discovery = False  # looks for new sensors, in automatic mode
+        self.discoveryInterval = 0  # minutes, 0 when the background discovery is disabled
+        self.nextDiscovery = 0
+        self.discovering = None  # adapter of the background scan in progress
+        self.discoveryCount = 0
+        self.sharedCache = None  # readings shared with the other programs reading the sensors
+        self.coordinator = None  # receives the snapshots of the collector nodes
+        self.leases = None  # which node polls which sensor, the plugin being one of the nodes
+        self.startTime = 0
+        self.firstPolls = set()  # known sensors not polled yet since the start, the scans wait for them
+        self.firstReading = False
         return
 
 
     def onStart(self):
         #Domoticz.Debugging(1)
+        self.startTime = time.time()
 
         if bluepyError == 1:
             Domoticz.Error("Error loading Parrot Flower libraries")
 
+        # get the backend
+        try:
+            self.backend = loadBackend(Parameters["Mode3"])
+        except (ImportError, AttributeError, KeyError) as error:
+            Domoticz.Error("Error loading the " + str(Parameters["Mode3"]) + " backend: " + str(error) +
+                           ", the sensors are not polled")
+            return
+
+        self.options = parseOptions(Parameters["Mode6"])
+        self.metricsDevices = self.options.get("metrics_devices", "0") == "1"
+        self.metricsInterval = self.intOption("metrics_interval", METRICS_INTERVAL)
+        self.aggregateDevices = self.options.get("aggregate_devices", "0") == "1"
+
+        # get the bluetooth adapters, each one polls its sensors in parallel with the others
+        adapters = [adapter.strip() for adapter in parseCSV(Parameters["Mode5"]) if adapter.strip()]
+        if adapters:
+            self.adapters = adapters
+        Domoticz.Log("Using bluetooth adapters " + ", ".join(self.adapters))
+
         Domoticz.Debug("Parrot Flower - devices made so far (max 255): " + str(len(Devices)))
 
+        self.openRegistry()
+
         # get the mac addresses of the sensors
         if Parameters["Mode1"] == 'auto':
+            # poll the known sensors right away, the scan for new ones runs after their first poll
             Domoticz.Log("Automatic mode is selected")
-            self.floraScan()
+            self.discovery = True
+            self.macs = self.registry.macs()
+            self.createSensors(self.macs)
         else:
             Domoticz.Log("Manual mode is selected")
-            self.macs = parseCSV(Parameters["Mode2"])
-            self.createSensors()
+            configured = parseMacs(Parameters["Mode2"])
+            # free the blocks of the sensors removed from the list, before registering the new ones
+            for mac in self.registry.macs():
+                if mac not in configured:
+                    self.registry.remove(mac)
+                    Domoticz.Log("Unregistered device: " + str(mac))
+            self.macs = [mac for mac in configured if self.registerSensor(mac)]
+            self.createSensors(self.macs)
         #Domoticz.Log("macs = {}".format(self.macs))
+        self.assignAdapters()
+        if self.metricsDevices:
+            self.createMetricsDevices()
 
-        # get the backend
-        if Parameters["Mode3"] == 'gatttool':
-            self.backend = GatttoolBackend
-        elif Parameters["Mode3"] == 'bluepy':
-            self.backend = BluepyBackend
-        elif Parameters["Mode3"] == 'pygatt':
-            self.backend = PygattBackend
+        # a hung connection is cancelled and counted as a failure after these deadlines
+        self.bleTimeout = self.intOption("ble_timeout", BLE_TIMEOUT)
+        self.sessionTimeout = max(self.intOption("session_timeout", SESSION_TIMEOUT), self.bleTimeout)
+        Domoticz.Log("Using bluetooth timeouts of " + str(self.bleTimeout) + " seconds to connect, " +
+                     str(self.sessionTimeout) + " seconds per poll")
 
         # check polling interval parameter
         try:
@@ -100,9 +231,109 @@ class BasePlugin:
             self.pollinterval = temp
         Domoticz.Log("Using polling interval of {} minutes".format(str(self.pollinterval)))
 
+        # readings shared with the other programs reading the sensors, in the given directory
+        if self.options.get("shared_cache"):
+            self.sharedCache = SharedCache(self.options["shared_cache"], self.pollinterval * 60)
+            Domoticz.Log("Sharing the readings in " + self.options["shared_cache"])
+
+        # refresh intervals of the measurements
+        for key, value in self.options.items():
+            if key.endswith("_interval") and key[:-len("_interval")] in MEASUREMENTS:
+                try:
+                    self.parameterIntervals[key[:-len("_interval")]] = int(value)
+                except ValueError:
+                    Domoticz.Error("Invalid option " + key + ": " + value)
+        Domoticz.Log("Using refresh intervals (minutes) " + str(self.parameterIntervals))
+
+        # local history of the readings, kept history_days days
+        historyDays = self.intOption("history_days", HISTORY_DAYS)
+        self.timeseries = TimeSeriesStore(os.path.join(Parameters["HomeFolder"], "ParrotFlowerData"),
+                                          historyDays * 24 * 60 // self.pollinterval + 1)
+
+        # device updates within the deadbands are skipped, but devices are refreshed every refresh_max minutes
+        deadbands = dict(DEADBANDS)
+        for key, value in self.options.items():
+            if key.startswith("deadband_"):
+                try:
+                    deadbands[key[len("deadband_"):]] = float(value)
+                except ValueError:
+                    Domoticz.Error("Invalid option " + key + ": " + value)
+        # the statistics use the deadband of their measurement
+        for key, name, typeName, unitName in AGGREGATE_DEVICES:
+            metric = key.rsplit("_", 1)[0]
+            if key not in deadbands and metric in deadbands:
+                deadbands[key] = deadbands[metric]
+        refreshMax = self.intOption("refresh_max", REFRESH_MAX)
+        self.deadband = Deadband(deadbands, refreshMax * 60)
+        Domoticz.Log("Using deadbands " + str(deadbands) + ", refreshing devices every " + str(refreshMax) + " minutes")
+
+        # each sensor is polled on its own schedule, failing sensors are retried less often
+        maxInterval = self.intOption("backoff_max", 4 * self.pollinterval)
+        self.scheduler = PollScheduler(self.pollinterval * 60, POLL_JITTER, RETRY_DELAY * 60,
+                                       max(maxInterval, self.pollinterval) * 60)
+        for mac in self.macs:
+            self.scheduler.add(mac, 0)
+        self.firstPolls = set(self.macs)
+
+        # sensors with a low battery, or whose polls take long or often fail, are polled less often
+        self.pollMin = max(self.intOption("poll_min", self.pollinterval), 1)
+        pollMax = max(self.intOption("poll_max", 4 * self.pollinterval), self.pollMin)
+        self.policy = BatteryPolicy(self.pollinterval * 60, self.pollMin * 60, pollMax * 60,
+                                    self.intOption("battery_low", BATTERY_LOW))
+        Domoticz.Log("Polling the sensors every " + str(self.pollMin) + " to " + str(pollMax) + " minutes")
+
+        # daily light integral and min/max/mean of the last aggregate_hours hours, updated with each reading,
+        # the light is integrated between readings as far apart as the longest polling interval
+        self.aggregates = AggregateStore(os.path.join(Parameters["HomeFolder"], "ParrotFlowerAggregates.json"),
+                                         self.intOption("aggregate_hours", AGGREGATE_HOURS) * 3600,
+                                         pollMax * 60 * (1 + POLL_JITTER))
+
+        # bluetooth reads are done by worker threads, the heartbeat only queues them
+        self.pool = PollerPool(self.adapters, POLL_WORKERS, POLL_QUEUE_SIZE)
+
+        # other hosts can poll the sensors out of range, each sensor is polled by the host receiving it best
+        coordinatorPort = self.intOption("coordinator_port", 0)
+        if coordinatorPort > 0:
+            allowed = None if Parameters["Mode1"] == 'auto' else (lambda mac: mac in self.macs)
+            self.leases = LeaseTable(3 * self.pollinterval * 60, allowed=allowed)
+            # only local collectors can connect unless coordinator_host is set
+            coordinatorHost = self.options.get("coordinator_host", "127.0.0.1")
+            if coordinatorHost not in ("127.0.0.1", "localhost") and not self.options.get("coordinator_key"):
+                Domoticz.Error("The coordinator listens on " + (coordinatorHost or "all interfaces") +
+                               " without coordinator_key, any host can push readings")
+            try:
+                self.coordinator = Coordinator(self.leases, coordinatorHost, coordinatorPort,
+                                               self.options.get("coordinator_key"), self.pollinterval * 60)
+                Domoticz.Log("Coordinating the collector nodes on " + (coordinatorHost or "all interfaces") +
+                             ", port " + str(coordinatorPort))
+            except OSError as error:
+                Domoticz.Error("Can't start the coordinator on port " + str(coordinatorPort) + ": " + str(error))
+                self.leases = None
+
+        # in automatic mode, new sensors are looked for between the polls
+        if self.discovery:
+            self.discoveryInterval = self.intOption("discovery_interval", DISCOVERY_INTERVAL)
+            self.nextDiscovery = 0
+            if self.discoveryInterval > 0:
+                Domoticz.Log("Looking for new sensors every " + str(self.discoveryInterval) + " minutes")
+
+        Domoticz.Log("Started in " + str(round(time.time() - self.startTime, 2)) + " seconds, polling " +
+                     str(len(self.macs)) + " known sensors")
+
 
     def onStop(self):
         Domoticz.Log("onStop called")
+        if self.coordinator is not None:
+            self.coordinator.stop()
+            self.coordinator = None
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+        self.pollers = {}
+        self.saveAggregates()
+        if self.timeseries is not None:
+            self.timeseries.close()
+            self.timeseries = None
 
 
     def onConnect(self, Connection, Status, Description):
@@ -118,145 +349,429 @@ class BasePlugin:
 
 
     def onHeartbeat(self):
-        now = datetime.now()
-        if now >= self.nextupdate:
-            self.nextupdate = now + timedelta(minutes=self.pollinterval)
-            #By setting this to 0, the polling function will run.
-            self.currentlyPolling = 0
-
-        # for now this uses the shelve database as its source of truth.
-        if (self.currentlyPolling < len(self.macs)):
+        if self.pool is None:
+            return
+        start = time.perf_counter()
+
+        # publish the data read by the workers since the last heartbeat
+        for (mac, values, error) in self.pool.results():
+            try:
+                self.pollDone(mac, values, error)
+            except Exception as exception:
+                Domoticz.Error("Can't publish the data of sensor " + str(mac) + ": " + str(exception))
+                # never leave a sensor in flight, it would not be polled again
+                self.scheduler.postpone(mac, RETRY_DELAY * 60)
+
+        # publish the data pushed by the collector nodes
+        if self.coordinator is not None:
+            for (node, snapshot) in self.coordinator.snapshots():
+                try:
+                    self.remoteSnapshot(node, snapshot)
+                except Exception as error:
+                    Domoticz.Error("Can't publish the snapshot of sensor " + str(snapshot.get("mac")) +
+                                   " from node " + str(node) + ": " + str(error))
+
+        # queue a poll of the sensors which are due, the workers do the bluetooth reads
+        for mac in self.scheduler.due():
+            if self.leases is not None and not self.claimLocal(mac):
+                Domoticz.Debug("Sensor " + str(mac) + " is polled by node " + str(self.leases.holder(mac)))
+                self.scheduler.postpone(mac, self.pollinterval * 60)
+                self.firstPollDone(mac)
+                continue
+            try:
+                if not self.pool.submit(self.sensorAdapters[mac], mac, self.getPlantData, self.getPoller(mac)):
+                    Domoticz.Error("Polling queue full, postponing sensor " + str(mac))
+                    self.scheduler.postpone(mac, RETRY_DELAY * 60)
+            except Exception as error:
+                # never leave a sensor in flight, it would not be polled again
+                Domoticz.Error("Can't poll sensor " + str(mac) + ": " + str(error))
+                self.scheduler.failure(mac)
+
+        # look for new sensors when an adapter has no poll waiting, one adapter after the other,
+        # once the known sensors were polled
+        if self.discovery and self.discovering is None and not self.firstPolls and time.time() >= self.nextDiscovery:
+            adapter = self.adapters[self.discoveryCount % len(self.adapters)]
+            if self.discoveryCount < len(self.adapters):
+                # the first scans, with every adapter, stop once they received all the known sensors
+                timeout, expected = SCAN_TIMEOUT, self.registry.macs() or None
+            else:
+                timeout, expected = DISCOVERY_TIMEOUT, None
+            if self.pool.pending(adapter) == 0 and \
+                    self.pool.submit(adapter, DISCOVERY_KEY, self.discoverSensors, adapter, timeout, expected):
+                self.discovering = adapter
+                self.discoveryCount += 1
+
+        METRICS.observe("parrot_flower_heartbeat_seconds", time.perf_counter() - start)
+        if time.time() >= self.nextMetrics:
+            self.nextMetrics = time.time() + self.metricsInterval * 60
+            self.publishMetrics()
+            self.saveAggregates()
+
+    # function to publish the result of a job of the workers
+    def pollDone(self, mac, values, error):
+        if mac == DISCOVERY_KEY:
+            self.discoveryDone(values, error)
+            return
+        self.firstPollDone(mac)
+        METRICS.increment("parrot_flower_polls_total", adapter=self.sensorAdapters.get(mac),
+                          result="ok" if error is None else "error")
+        if error is not None:
+            self.scheduler.failure(mac)
+            self.policy.failure(mac)
+            Domoticz.Error("Can't get data from sensor " + str(mac) + ": " + str(error) +
+                           " (" + str(self.scheduler.failures(mac)) + " failures)")
+        elif mac in self.macs:
+            interval = self.policy.success(mac, values[P_BATTERY], values["radio_time"])
+            if interval != self.pollinterval * 60:
+                Domoticz.Debug("Sensor " + str(mac) + " polled every " + str(round(interval / 60)) +
+                               " minutes (battery " + str(values[P_BATTERY]) + "%, cost " +
+                               str(round(self.policy.cost(mac) or 0, 2)) + " s)")
+            self.scheduler.success(mac, interval)
+            if not self.firstReading:
+                self.firstReading = True
+                METRICS.observe("parrot_flower_first_reading_seconds", time.time() - self.startTime)
+                Domoticz.Log("First reading after " + str(round(time.time() - self.startTime, 1)) +
+                             " seconds, from sensor " + str(mac))
+            self.updatePlantDevices(mac, values)
+            self.updateAggregates(mac, time.time(), values)
+            self.timeseries.append(mac, time.time(), values)
+            self.registry.update(mac, name=values["name"], firmware=values["firmware"],
+                                 adapter=self.sensorAdapters[mac], last_seen=int(time.time()))
+
+    # function to write the metrics snapshot files, and update the metrics devices
+    def publishMetrics(self):
+        try:
+            METRICS.write(os.path.join(Parameters["HomeFolder"], "ParrotFlowerMetrics.json"))
+            METRICS.write(os.path.join(Parameters["HomeFolder"], "ParrotFlowerMetrics.prom"))
+        except OSError as error:
+            Domoticz.Error("Can't write the metrics: " + str(error))
+
+        if self.metricsDevices:
+            values = (
+                round(METRICS.histogram("parrot_flower_session_seconds").mean() * 1000),
+                METRICS.counter("parrot_flower_failures_total"),
+                round(METRICS.histogram("parrot_flower_heartbeat_seconds").mean() * 1000, 1),
+            )
+            for (unit, name, unitName), value in zip(METRICS_DEVICES, values):
+                if unit in Devices:
+                    Devices[unit].Update(nValue=0, sValue=str(value))
+
+    # function to create the devices showing the plugin metrics
+    def createMetricsDevices(self):
+        for unit, name, unitName in METRICS_DEVICES:
+            if unit not in Devices:
+                if any(self.sensorUnit(mac) + UNITS_PER_SENSOR > unit for mac in self.registry.macs()):
+                    Domoticz.Error("Unit " + str(unit) + " is used by a sensor, can't create the metrics devices")
+                    return
+                Domoticz.Device(Name=name, Unit=unit, TypeName="Custom", Options={"Custom": "1;" + unitName},
+                                Used=1).Create()
+                Domoticz.Log("Created device: " + name)
+
+
+    # function to get an integer option, or its default value if it is missing or invalid
+    def intOption(self, key, default):
+        try:
+            return int(self.options.get(key, default))
+        except ValueError:
+            Domoticz.Error("Invalid option " + key + ": " + self.options[key])
+            return default
+
+    # function to open the sensor registry, importing the macs of the former shelve database
+    def openRegistry(self):
+        maxSensors = MAX_SENSORS
+        if self.metricsDevices:
+            # keep the last units for the metrics devices
+            maxSensors = (METRICS_DEVICES[0][0] - 1) // UNITS_PER_SENSOR
+        filename = os.path.join(Parameters["HomeFolder"], "ParrotFlower.registry")
+        if self.aggregateDevices:
+            # the statistics devices follow the units of the sensors, no registered sensor may use them
+            self.registry = SensorRegistry(filename)
+            if any(self.sensorUnit(mac) + UNITS_PER_SENSOR > AGGREGATE_UNIT for mac in self.registry.macs()):
+                Domoticz.Error("Units " + str(AGGREGATE_UNIT) + " and up are used by sensors, " +
+                               "can't create the statistics devices")
+                self.aggregateDevices = False
+            else:
+                # keep units for the statistics devices of each sensor
+                maxSensors = min(maxSensors, AGGREGATE_MAX_SENSORS)
+        self.registry = SensorRegistry(filename, maxSensors)
+        if len(self.registry) == 0:
             try:
-                self.getPlantData(int(self.currentlyPolling))
+                database = shelve.open('ParrotFlower', flag='r')
+                knownSensors = database.get('macs', [])
+                database.close()
             except:
-                Domoticz.Error("Can't get data from sensor " + str(self.macs[self.currentlyPolling]))
-            self.currentlyPolling = self.currentlyPolling + 1
-
+                knownSensors = []
+            for mac in knownSensors:
+                self.registerSensor(mac)
+            if knownSensors:
+                Domoticz.Log("Imported " + str(len(knownSensors)) + " sensors from the shelve database")
+        Domoticz.Log("Already known devices: " + str(self.registry.macs()))
+
+    # function to add a sensor to the registry, returns False if there are no free units
+    def registerSensor(self, mac):
+        if mac not in self.registry:
+            if self.registry.add(mac) is None:
+                Domoticz.Error("Too many sensors, ignoring " + str(mac))
+                return False
+            Domoticz.Log("Registered new device: " + str(mac))
+        return True
+
+    # function to make a sensor use the adapter receiving it best
+    def recordSignal(self, mac, adapter, rssi):
+        if rssi is None:
+            return
+        record = self.registry.get(mac)
+        if record.rssi is None or record.adapter == adapter or rssi > record.rssi:
+            if record.adapter != adapter:
+                Domoticz.Debug("Sensor " + str(mac) + " received at " + str(rssi) + " dBm by adapter " + adapter)
+            self.registry.update(mac, adapter=adapter, rssi=rssi)
+
+    # function to get the first Domoticz unit of a sensor
+    def sensorUnit(self, mac):
+        return self.registry.get(mac).block * UNITS_PER_SENSOR + 1
 
     # function to create corresponding sensors in Domoticz if there are Parrot Flower which don't have them yet.
-    def createSensors(self):
-        # create the domoticz sensors if necessary
-        if (len(Devices) / 5) < len(self.macs):
-            Domoticz.Debug("Creating new sensors")
-            # Create the sensors. Later we get the data.
-            for idx, mac in enumerate(self.macs):
+    def createSensors(self, macs):
+        # Create the sensors. Later we get the data.
+        for mac in macs:
+            block = self.registry.get(mac).block
+            sensorBaseName = "#" + str(block) + " "
+
+            sensorNumber = self.sensorUnit(mac)
+            if sensorNumber not in Devices:
                 Domoticz.Debug("Creating new sensors for Parrot Flower Power & Pot at " + str(mac))
-                sensorBaseName = "#" + str(idx) + " "
-
-                sensorNumber = (idx * 5) + 1
-                if sensorNumber not in Devices:
-
-                    #moisture
-                    sensorName = sensorBaseName + "Moisture"
-                    Domoticz.Debug("Creating first sensor, #" + str(sensorNumber))
-                    Domoticz.Debug("Creating first sensor, name: " + str(sensorName))
-                    Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Percentage", Used=1).Create()
-                    Domoticz.Log("Created device: " + sensorName)
-
-                    #air temperature
-                    sensorNumber = (idx * 5) + 2
-                    sensorName = sensorBaseName + "Air Temperature"
-                    Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Temperature", Used=1).Create()
-                    Domoticz.Log("Created device: " + sensorName)
-
-                    #light
-                    sensorNumber = (idx * 5) + 3
-                    sensorName = sensorBaseName + "Light"
-                    Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Illumination", Used=1).Create()
-                    Domoticz.Log("Created device: " + sensorName)
-
-                    #fertility
-                    sensorNumber = (idx * 5) + 4
-                    sensorName = sensorBaseName + "Conductivity"
-                    Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Custom", Used=1).Create()
-                    Domoticz.Log("Created device: " + sensorName)
-
-                    #soil temperature
-                    sensorNumber = (idx * 5) + 5
-                    sensorName = sensorBaseName + "Soil Temperature"
-                    Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Temperature", Used=1).Create()
-                    Domoticz.Log("Created device: " + sensorName)
-
-    # function to poll a Flower Mate for its data
-    def getPlantData(self, idx):
-        #for idx, mac in enumerate(self.macs):
-        mac = self.macs[idx]
-        Domoticz.Log("Getting data from sensor: " + str(mac))
-        poller = ParrotFlowerPoller(str(mac), self.backend)
-
-        val_bat  = int("{}".format(poller.parameter_value(P_BATTERY)))
-        nValue = 0
+
+                #moisture
+                sensorName = sensorBaseName + "Moisture"
+                Domoticz.Debug("Creating first sensor, #" + str(sensorNumber))
+                Domoticz.Debug("Creating first sensor, name: " + str(sensorName))
+                Domoticz.Device(Name=sensorName, Unit=sensorNumber, TypeName="Percentage", Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+                #air temperature
+                sensorName = sensorBaseName + "Air Temperature"
+                Domoticz.Device(Name=sensorName, Unit=sensorNumber + 1, TypeName="Temperature", Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+                #light
+                sensorName = sensorBaseName + "Light"
+                Domoticz.Device(Name=sensorName, Unit=sensorNumber + 2, TypeName="Illumination", Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+                #fertility
+                sensorName = sensorBaseName + "Conductivity"
+                Domoticz.Device(Name=sensorName, Unit=sensorNumber + 3, TypeName="Custom", Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+                #soil temperature
+                sensorName = sensorBaseName + "Soil Temperature"
+                Domoticz.Device(Name=sensorName, Unit=sensorNumber + 4, TypeName="Temperature", Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+            if self.aggregateDevices:
+                self.createAggregateDevices(mac)
+
+    # function to get the first Domoticz unit of the statistics devices of a sensor
+    def aggregateUnit(self, mac):
+        return AGGREGATE_UNIT + self.registry.get(mac).block * len(AGGREGATE_DEVICES)
+
+    # function to create the devices showing the rolling statistics of a sensor
+    def createAggregateDevices(self, mac):
+        block = self.registry.get(mac).block
+        unit = self.aggregateUnit(mac)
+        for offset, (key, name, typeName, unitName) in enumerate(AGGREGATE_DEVICES):
+            if unit + offset not in Devices:
+                sensorName = "#" + str(block) + " " + name
+                options = {"Custom": "1;" + unitName} if unitName is not None else {}
+                Domoticz.Device(Name=sensorName, Unit=unit + offset, TypeName=typeName, Options=options,
+                                Used=1).Create()
+                Domoticz.Log("Created device: " + sensorName)
+
+    # function to get the poller of a sensor, it is created on first use and then reused
+    def getPoller(self, mac):
+        poller = self.pollers.get(mac)
+        if poller is None:
+            # measurements without an interval are read on every poll, keep a margin
+            # so that a poll arriving early because of the jitter still reads them
+            cacheTimeout = min(self.pollinterval, self.pollMin) * 60 * 0.8
+            parameterTimeouts = dict((parameter, interval * 60 * 0.8)
+                                     for parameter, interval in self.parameterIntervals.items())
+            # gatttool runs one command per read, bound each of them too
+            backendOptions = {"timeout": self.bleTimeout} if self.backend.__name__ == "GatttoolBackend" else {}
+            poller = ParrotFlowerPoller(str(mac), self.backend, cache_timeout=cacheTimeout,
+                                        adapter=self.sensorAdapters[mac],
+                                        parameter_timeouts=parameterTimeouts,
+                                        ble_timeout=self.bleTimeout, session_timeout=self.sessionTimeout,
+                                        backend_options=backendOptions, shared_cache=self.sharedCache)
+            self.pollers[mac] = poller
+        return poller
+
+    # function to give each sensor the adapter which received it best, spreading the others evenly
+    def assignAdapters(self):
+        for mac in list(self.sensorAdapters):
+            if mac not in self.macs or self.sensorAdapters[mac] not in self.adapters:
+                del self.sensorAdapters[mac]
+        for mac in self.macs:
+            record = self.registry.get(mac)
+            if mac not in self.sensorAdapters and record is not None and record.adapter in self.adapters:
+                # keep the adapter used before the restart
+                self.sensorAdapters[mac] = record.adapter
+        for mac in self.macs:
+            if mac not in self.sensorAdapters:
+                counts = [list(self.sensorAdapters.values()).count(adapter) for adapter in self.adapters]
+                self.sensorAdapters[mac] = self.adapters[counts.index(min(counts))]
+                Domoticz.Debug("Sensor " + str(mac) + " uses adapter " + self.sensorAdapters[mac])
+
+    # function to scan for sensors, runs on a worker thread of the adapter between its polls
+    def discoverSensors(self, adapter, timeout, expected):
+        # the adapter lock also keeps the polls of other workers of the adapter away
+        with adapter_lock(adapter):
+            return list(parrot_flower_scanner.scan_iter(self.backend, timeout, expected=expected, adapter=adapter))
+
+    # function to register the sensors found by discoverSensors and start polling them
+    def discoveryDone(self, devices, error):
+        adapter, self.discovering = self.discovering, None
+        if self.discoveryCount < len(self.adapters):
+            # the first scans go through every adapter without waiting
+            self.nextDiscovery = time.time()
+        elif self.discoveryInterval > 0:
+            self.nextDiscovery = time.time() + self.discoveryInterval * 60
+        else:
+            self.discovery = False
+        if error is not None:
+            Domoticz.Error("Scan for new sensors failed on adapter " + str(adapter) + ": " + str(error))
+            return
+        Domoticz.Debug("Adapter " + str(adapter) + " received " + str(len(devices)) + " sensors")
+        newMacs = []
+        for (mac, name, rssi) in devices:
+            if mac not in self.registry:
+                if not self.registerSensor(mac):
+                    continue
+                newMacs.append(mac)
+            self.recordSignal(mac, adapter, rssi)
+        if self.discoveryCount == len(self.adapters):
+            # after the first scans, poll the known sensors with the adapter receiving them best
+            for mac in self.macs:
+                record = self.registry.get(mac)
+                if record.adapter in self.adapters and record.adapter != self.sensorAdapters.get(mac):
+                    Domoticz.Log("Sensor " + str(mac) + " moves to adapter " + record.adapter)
+                    self.sensorAdapters[mac] = record.adapter
+                    self.pollers.pop(mac, None)
+        if newMacs:
+            Domoticz.Log("Found new sensors " + ", ".join(newMacs))
+            self.createSensors(newMacs)
+            self.macs = self.registry.macs()
+            self.assignAdapters()
+            for mac in newMacs:
+                self.scheduler.add(mac)
+
+    # function to record that a sensor known at the start was polled, the scans wait for all of them
+    def firstPollDone(self, mac):
+        if mac in self.firstPolls:
+            self.firstPolls.discard(mac)
+            if not self.firstPolls:
+                Domoticz.Log("Polled the known sensors in " + str(round(time.time() - self.startTime, 1)) + " seconds")
+
+    # function to check if the plugin polls a sensor itself, or leaves it to a collector node receiving it better
+    def claimLocal(self, mac):
+        record = self.registry.get(mac)
+        return mac in self.leases.claim(LOCAL_NODE, {mac: record.rssi if record is not None else None})
+
+    # function to publish a snapshot pushed by a collector node, registering the sensor if needed
+    def remoteSnapshot(self, node, snapshot):
+        mac = snapshot["mac"]
+        METRICS.increment("parrot_flower_remote_snapshots_total", node=node)
+        if mac not in self.registry:
+            if not self.registerSensor(mac):
+                return
+            self.createSensors([mac])
+            self.macs = self.registry.macs()
+            self.assignAdapters()
+            self.scheduler.add(mac)
+        # the clock of the node may differ: a snapshot from the future is dated now, the history must stay
+        # in time order so a snapshot older than the last reading of the sensor is dropped
+        timestamp = min(snapshot["timestamp"], time.time())
+        latest = self.timeseries.series(mac).latest()
+        if latest and timestamp < latest[0].timestamp:
+            Domoticz.Debug("Dropping the snapshot of sensor " + str(mac) + " from node " + str(node) +
+                           ", older than its last reading")
+            return
+        Domoticz.Debug("Snapshot of sensor " + str(mac) + " from node " + str(node))
+        values = dict(snapshot["values"])
+        values["name"] = snapshot.get("name")
+        values["firmware"] = snapshot.get("firmware")
+        self.updatePlantDevices(mac, values)
+        self.updateAggregates(mac, timestamp, values)
+        self.timeseries.append(mac, timestamp, values)
+        self.registry.update(mac, name=values["name"], firmware=values["firmware"], last_seen=int(timestamp))
+
+    # function to poll a Flower Mate for its data, runs on a worker thread
+    def getPlantData(self, poller):
+        # the Domoticz API must only be used from the plugin thread
+        radioTime = poller.radio_time
+        values = {}
+        for parameter in (P_BATTERY, P_MOISTURE, P_AIR_TEMPERATURE, P_LIGHT, P_CONDUCTIVITY, P_SOIL_TEMPERATURE):
+            values[parameter] = poller.parameter_value(parameter)
+        # read with the measurements on first contact, then cached
+        values["name"] = poller.name()
+        values["firmware"] = poller.firmware_version()
+        values["radio_time"] = poller.radio_time - radioTime
+        return values
+
+    # function to update the Domoticz devices of a sensor with the data read by getPlantData
+    def updatePlantDevices(self, mac, values):
+        Domoticz.Log("Updating data from sensor: " + str(mac))
+        unit = self.sensorUnit(mac)
+
+        val_bat  = int("{}".format(values[P_BATTERY]))
 
         #moisture
-        sensorNumber1 = (idx * 5) + 1
-        val_moist = "{}".format(poller.parameter_value(P_MOISTURE))
-        Devices[sensorNumber1].Update(nValue=nValue, sValue=val_moist, BatteryLevel=val_bat)
-        Domoticz.Log("moisture = " + str(val_moist))
+        self.updateDevice(unit + 0, "moisture", values[P_MOISTURE], val_bat)
 
         #air temperature
-        sensorNumber2 = (idx * 5) + 2
-        val_air_temp = "{}".format(poller.parameter_value(P_AIR_TEMPERATURE))
-        Devices[sensorNumber2].Update(nValue=nValue, sValue=val_air_temp, BatteryLevel=val_bat)
-        Domoticz.Log("air temperature = " + str(val_air_temp))
+        self.updateDevice(unit + 1, "air_temperature", values[P_AIR_TEMPERATURE], val_bat)
 
         #light
-        sensorNumber3 = (idx * 5) + 3
-        val_lux = "{}".format(poller.parameter_value(P_LIGHT) * 54)
-        Devices[sensorNumber3].Update(nValue=nValue, sValue=val_lux, BatteryLevel=val_bat)
-        Domoticz.Log("light = " + str(val_lux))
+        self.updateDevice(unit + 2, "light", values[P_LIGHT] * 54, val_bat)
 
         #fertility
-        sensorNumber4 = (idx * 5) + 4
-        val_cond = "{}".format(poller.parameter_value(P_CONDUCTIVITY))
-        Devices[sensorNumber4].Update(nValue=nValue, sValue=val_cond, BatteryLevel=val_bat)
-        Domoticz.Log("conductivity = " + str(val_cond))
+        self.updateDevice(unit + 3, "conductivity", values[P_CONDUCTIVITY], val_bat)
 
         #soil temperature
-        sensorNumber5 = (idx * 5) + 5
-        val_soil_temp = "{}".format(poller.parameter_value(P_SOIL_TEMPERATURE))
-        Devices[sensorNumber5].Update(nValue=nValue, sValue=val_soil_temp, BatteryLevel=val_bat)
-        Domoticz.Log("soil temperature = " + str(val_soil_temp))
-
-    # function to scan for devices, and store and compare the outcome
-    def floraScan(self):
-        Domoticz.Log("Scanning for Parrot Flower Power & Pot sensors")
-
-        #databaseFile=os.path.join(os.environ['HOME'],'ParrotFlower')
-        # first, let's get the list of devices we already know about
-        database = shelve.open('ParrotFlower')
-
-        try:
-            knownSensors = database['macs']
-            oldLength = len(knownSensors)
-            Domoticz.Debug("Already know something:" + str(oldLength))
-            Domoticz.Log("Already known devices:" + str(knownSensors))
-        except:
-            knownSensors = []
-            database['macs'] = knownSensors
-            oldLength = 0;
-            Domoticz.Debug("No existing sensors in system?")
-
-        #Next we scan to look for new sensors
-        try:
-            foundParrots = parrot_flower_scanner.scan(self.backend, 5)
-            Domoticz.Log("Number of devices found via bluetooth scan = " + str(len(foundParrots)))
-        except:
-            foundParrots = []
-            Domoticz.Log("Scan failed")
-
-        for sensor in foundParrots:
-            if sensor not in knownSensors:
-                knownSensors.append(str(sensor))
-                Domoticz.Log("Found new device: " + str(sensor))
-
-        if len(knownSensors) != oldLength:
-            database['macs'] = knownSensors
-            Domoticz.Log("Updating database")
-
-        database.close()
-
-        self.macs = knownSensors
-        self.createSensors()
+        self.updateDevice(unit + 4, "soil_temperature", values[P_SOIL_TEMPERATURE], val_bat)
+
+    # function to add a reading to the rolling statistics of a sensor, and update its statistics devices
+    def updateAggregates(self, mac, timestamp, values):
+        stats = self.aggregates.add(mac, timestamp, values)
+        Domoticz.Debug("Statistics of sensor " + str(mac) + ": " +
+                       ", ".join(key + " = " + str(round(value, 2)) for key, value in sorted(stats.items())
+                                 if value is not None))
+        if not self.aggregateDevices:
+            return
+        unit = self.aggregateUnit(mac)
+        val_bat = int("{}".format(values[P_BATTERY]))
+        for offset, (key, name, typeName, unitName) in enumerate(AGGREGATE_DEVICES):
+            if stats[key] is not None and unit + offset in Devices:
+                self.updateDevice(unit + offset, key, round(stats[key], 2), val_bat)
+
+    # function to write the rolling statistics, they are kept across restarts
+    def saveAggregates(self):
+        if self.aggregates is not None:
+            try:
+                self.aggregates.save()
+            except OSError as error:
+                Domoticz.Error("Can't write the statistics: " + str(error))
+
+    # function to update a Domoticz device, unless its value is within the deadband of the last update
+    def updateDevice(self, unit, metric, value, battery):
+        if unit not in Devices:
+            Domoticz.Debug("Device " + str(unit) + " was deleted, not updating " + metric.replace("_", " "))
+        elif self.deadband.should_publish(unit, metric, value, battery):
+            Devices[unit].Update(nValue=0, sValue="{}".format(value), BatteryLevel=battery)
+            self.deadband.published(unit, value, battery)
+            Domoticz.Log(metric.replace("_", " ") + " = " + str(value))
+        else:
+            Domoticz.Debug(metric.replace("_", " ") + " = " + str(value) + " (unchanged, not updated)")
 
 
 global _plugin
@@ -283,8 +798,26 @@ def onHeartbeat():
     _plugin.onHeartbeat()
 
 
+def loadBackend(name):
+    module, className = BACKENDS[name]
+    return getattr(importlib.import_module(module), className)
+
+
+def parseMacs(strCSV):
+    return [mac.strip().upper() for mac in parseCSV(strCSV) if mac.strip()]
+
+
 def parseCSV(strCSV):
     listvals = []
     for value in strCSV.split(","):
         listvals.append(value)
-    return listvals
\ No newline at end of file
+    return listvals
+
+
+def parseOptions(strOptions):
+    options = {}
+    for value in parseCSV(strOptions):
+        if "=" in value:
+            key, value = value.split("=", 1)
+            options[key.strip()] = value.strip()
+    return options